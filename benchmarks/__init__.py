@@ -0,0 +1 @@
+__all__ = ['cur_generator', 'stand_ins', 'run']
@@ -0,0 +1,204 @@
+import csv
+import datetime
+import gzip
+import io
+import random
+import string
+
+import dateutil.relativedelta
+
+GRANULARITY_HOURLY = 'hourly'
+GRANULARITY_DAILY = 'daily'
+GRANULARITY_MONTHLY = 'monthly'
+
+CUR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+BASE_HEADERS = [
+    'identity/LineItemId', 'identity/TimeInterval', 'bill/InvoiceId', 'bill/BillingEntity', 'bill/BillType',
+    'bill/PayerAccountId', 'bill/BillingPeriodStartDate', 'bill/BillingPeriodEndDate', 'lineItem/UsageAccountId',
+    'lineItem/LineItemType', 'lineItem/UsageStartDate', 'lineItem/UsageEndDate', 'lineItem/ProductCode',
+    'lineItem/UsageType', 'lineItem/Operation', 'lineItem/AvailabilityZone', 'lineItem/UsageAmount',
+    'lineItem/NormalizationFactor', 'lineItem/NormalizedUsageAmount', 'lineItem/CurrencyCode',
+    'lineItem/UnblendedRate', 'lineItem/UnblendedCost', 'lineItem/BlendedRate', 'lineItem/BlendedCost',
+    'lineItem/LineItemDescription', 'lineItem/TaxType', 'product/ProductName', 'product/ecu',
+    'product/instanceType', 'product/location', 'product/productFamily', 'product/region', 'product/servicecode',
+    'product/sku', 'product/usagetype', 'product/vcpu', 'pricing/publicOnDemandCost', 'pricing/publicOnDemandRate',
+    'pricing/term', 'pricing/unit', 'reservation/AmortizedUpfrontCostForUsage', 'reservation/EffectiveCost',
+    'reservation/RecurringFeeForUsage', 'savingsPlan/SavingsPlanEffectiveCost',
+    'savingsPlan/SavingsPlanRate', 'savingsPlan/UsedCommitment',
+]
+RESOURCE_ID_HEADER = 'lineItem/ResourceId'
+TAG_HEADER_FORMAT = 'resourceTags/user:tag-{}'
+
+# (product code, product name, service code, product family, usage types, unit)
+_PRODUCTS = [
+    ('AmazonEC2', 'Amazon Elastic Compute Cloud', 'AmazonEC2', 'Compute Instance',
+     ['BoxUsage:m5.large', 'BoxUsage:c5.xlarge', 'EBS:VolumeUsage.gp2'], 'Hrs'),
+    ('AmazonS3', 'Amazon Simple Storage Service', 'AmazonS3', 'Storage',
+     ['TimedStorage-ByteHrs', 'Requests-Tier1', 'Requests-Tier2'], 'GB-Mo'),
+    ('AWSLambda', 'AWS Lambda', 'AWSLambda', 'Serverless',
+     ['Lambda-GB-Second', 'Request', 'DataTransfer-Out-Bytes'], 'Lambda-GB-Second'),
+    ('AmazonRDS', 'Amazon Relational Database Service', 'AmazonRDS', 'Database Instance',
+     ['InstanceUsage:db.r5.large', 'RDS:GP2-Storage'], 'Hrs'),
+    ('AmazonCloudWatch', 'AmazonCloudWatch', 'AmazonCloudWatch', 'Metric',
+     ['CW:MetricMonitorUsage', 'DataProcessing-Bytes'], 'Metrics'),
+]
+_REGIONS = [
+    ('us-east-1', 'US East (N. Virginia)'), ('us-west-2', 'US West (Oregon)'), ('eu-west-1', 'EU (Ireland)'),
+]
+_OPERATIONS = ['RunInstances', 'PutObject', 'GetObject', 'Invoke', 'CreateDBInstance', 'MetricStorage']
+_INSTANCE_TYPES = ['m5.large', 'c5.xlarge', 'r5.large', '']
+_ACCOUNTS = ['486140753397', '112233445566', '998877665544']
+_TAG_VALUES = ['production', 'staging', 'development', 'team-billing', 'team-platform', 'team-data', '']
+
+
+def report_month_range(event_time):
+    # type: (datetime.datetime) -> (datetime.datetime, datetime.datetime)
+    start = datetime.datetime(event_time.year, event_time.month, 1)
+    end = start + dateutil.relativedelta.relativedelta(months=1)
+    return start, end
+
+
+def report_headers(resource_ids=True, tag_columns=0):
+    # type: (bool, int) -> list[str]
+    headers = list(BASE_HEADERS)
+    if resource_ids:
+        headers.insert(headers.index('lineItem/UsageAmount'), RESOURCE_ID_HEADER)
+    headers.extend(TAG_HEADER_FORMAT.format(i) for i in range(tag_columns))
+    return headers
+
+
+class SyntheticCURGenerator(object):
+    """ Generates deterministic, CUR-shaped CSV rows of a configurable size and width """
+
+    def __init__(self, event_time, granularity=GRANULARITY_HOURLY, resource_ids=True, tag_columns=0, seed=0):
+        # type: (datetime.datetime, str, bool, int, int) -> None
+        if granularity not in (GRANULARITY_HOURLY, GRANULARITY_DAILY, GRANULARITY_MONTHLY):
+            raise ValueError("Unknown granularity: {}".format(granularity))
+        self._granularity = granularity
+        self._resource_ids = resource_ids
+        self._tag_columns = tag_columns
+        self._random = random.Random(seed)
+        self._period_start, self._period_end = report_month_range(event_time)
+        self.headers = report_headers(resource_ids, tag_columns)
+
+    def _usage_period(self, row_idx, rows):
+        # type: (int, int) -> (datetime.datetime, datetime.datetime)
+        if self._granularity == GRANULARITY_MONTHLY:
+            return self._period_start, self._period_end
+
+        step = datetime.timedelta(hours=1) if self._granularity == GRANULARITY_HOURLY else datetime.timedelta(days=1)
+        periods = int((self._period_end - self._period_start) / step)
+        # spread the rows evenly over the billing period, in chronological order like AWS does
+        start = self._period_start + step * (row_idx * periods // rows)
+        return start, start + step
+
+    def _line_item_id(self):
+        # type: () -> str
+        return ''.join(self._random.choice(string.ascii_lowercase + '234567') for _ in range(52))
+
+    def _amount(self, scale):
+        # type: (float) -> str
+        return '{:.10f}'.format(self._random.random() * scale)
+
+    def row(self, row_idx, rows):
+        # type: (int, int) -> list[str]
+        rnd = self._random
+        usage_start, usage_end = self._usage_period(row_idx, rows)
+        # a few Tax line items, dated at the start of the billing period, close the report
+        tax = row_idx >= rows - max(1, rows // 100)
+        if tax:
+            usage_start, usage_end = self._period_start, self._period_end
+        product_code, product_name, service_code, family, usage_types, unit = rnd.choice(_PRODUCTS)
+        usage_type = rnd.choice(usage_types)
+        region, location = rnd.choice(_REGIONS)
+        account = rnd.choice(_ACCOUNTS)
+        rate = rnd.choice(['0.0000000000', '0.0960000000', '0.1700000000', '0.0000166667'])
+        instance_type = rnd.choice(_INSTANCE_TYPES) if product_code == 'AmazonEC2' else ''
+        start = usage_start.strftime(CUR_TIME_FORMAT)
+        end = usage_end.strftime(CUR_TIME_FORMAT)
+
+        values = {
+            'identity/LineItemId': self._line_item_id(),
+            'identity/TimeInterval': '{}/{}'.format(start, end),
+            'bill/BillingEntity': 'AWS',
+            'bill/BillType': 'Anniversary',
+            'bill/PayerAccountId': _ACCOUNTS[0],
+            'bill/BillingPeriodStartDate': self._period_start.strftime(CUR_TIME_FORMAT),
+            'bill/BillingPeriodEndDate': self._period_end.strftime(CUR_TIME_FORMAT),
+            'lineItem/UsageAccountId': account,
+            'lineItem/LineItemType': 'Tax' if tax else 'Usage',
+            'lineItem/UsageStartDate': start,
+            'lineItem/UsageEndDate': end,
+            'lineItem/ProductCode': product_code,
+            'lineItem/UsageType': usage_type,
+            'lineItem/Operation': rnd.choice(_OPERATIONS),
+            'lineItem/AvailabilityZone': region + rnd.choice(['a', 'b', '']) if instance_type else '',
+            'lineItem/UsageAmount': self._amount(100),
+            'lineItem/NormalizationFactor': '4' if instance_type else '',
+            'lineItem/NormalizedUsageAmount': self._amount(400) if instance_type else '',
+            'lineItem/CurrencyCode': 'USD',
+            'lineItem/UnblendedRate': rate,
+            'lineItem/UnblendedCost': self._amount(10),
+            'lineItem/BlendedRate': rate,
+            'lineItem/BlendedCost': self._amount(10),
+            'lineItem/LineItemDescription': '${} per {} for {}'.format(rate[:5], unit, usage_type),
+            'product/ProductName': product_name,
+            'product/ecu': rnd.choice(['8', '20', '53.5']) if instance_type else '',
+            'product/instanceType': instance_type,
+            'product/location': location,
+            'product/productFamily': family,
+            'product/region': region,
+            'product/servicecode': service_code,
+            'product/sku': 'SKU{:013d}'.format(rnd.randrange(64)),
+            'product/usagetype': usage_type,
+            'product/vcpu': rnd.choice(['2', '4', '16']) if instance_type else '',
+            'pricing/publicOnDemandCost': self._amount(10),
+            'pricing/publicOnDemandRate': rate,
+            'pricing/term': 'OnDemand',
+            'pricing/unit': unit,
+            'savingsPlan/SavingsPlanEffectiveCost': self._amount(5) if instance_type else '',
+            'savingsPlan/SavingsPlanRate': rate if instance_type else '',
+            'savingsPlan/UsedCommitment': self._amount(5) if instance_type else '',
+        }
+        if self._resource_ids:
+            values[RESOURCE_ID_HEADER] = 'arn:aws:{}:{}:{}:resource/r-{:08x}'.format(
+                service_code.lower(), region, account, rnd.randrange(1 << 24))
+        for i in range(self._tag_columns):
+            values[TAG_HEADER_FORMAT.format(i)] = rnd.choice(_TAG_VALUES)
+
+        return [values.get(header, '') for header in self.headers]
+
+    def rows(self, rows):
+        # type: (int) -> 'Generator'
+        for row_idx in range(rows):
+            yield self.row(row_idx, rows)
+
+
+def write_report(path, rows, event_time, granularity=GRANULARITY_HOURLY, resource_ids=True, tag_columns=0, seed=0):
+    # type: (str, int, datetime.datetime, str, bool, int, int) -> dict
+    """ Writes a gzipped synthetic CUR part to path and returns its size metadata """
+    generator = SyntheticCURGenerator(event_time, granularity, resource_ids, tag_columns, seed)
+    raw_bytes = 0
+    with gzip.open(path, 'wb') as f:
+        buff = io.StringIO()
+        writer = csv.writer(buff, lineterminator='\n')
+        writer.writerow(generator.headers)
+        for row_idx, row in enumerate(generator.rows(rows)):
+            writer.writerow(row)
+            # keep the in-memory buffer small for large reports
+            if row_idx % 1000 == 0:
+                data = buff.getvalue().encode('utf-8')
+                raw_bytes += len(data)
+                f.write(data)
+                buff.seek(0)
+                buff.truncate()
+        data = buff.getvalue().encode('utf-8')
+        raw_bytes += len(data)
+        f.write(data)
+
+    return {
+        'rows': rows,
+        'columns': len(generator.headers),
+        'raw_bytes': raw_bytes,
+    }
@@ -0,0 +1,133 @@
+"""
+Compares the per-row dict + json.dumps path with the dictionary-encoded RowEncoder.
+
+Rows go through csv.reader first, so every cell is a fresh string like in the
+lambda function. Throughput is measured on encoding every row to JSON, and
+allocations on holding every parsed row in memory (live blocks and bytes, as
+seen by tracemalloc), which is what aggregating or diffing a report costs.
+The batch scenarios encode the rows in column chunks, the filtered one drops
+the rows of the earlier half of the usage hours before encoding.
+
+    python -m benchmarks.encoding --rows 50000 --tag-columns 50
+"""
+import argparse
+import csv
+import io
+import json
+import time
+import tracemalloc
+
+from src.lambda_function import _parse_file, get_fields_parser
+from src.row_encoder import RowEncoder
+
+from . import cur_generator
+from .run import DEFAULT_RESULTS_DIR, EVENT_TIME, save_results
+
+
+def _csv_rows(rows, tag_columns):
+    # type: (int, int) -> (list[str], list[list[str]])
+    generator = cur_generator.SyntheticCURGenerator(EVENT_TIME, resource_ids=True, tag_columns=tag_columns)
+    buff = io.StringIO()
+    writer = csv.writer(buff, lineterminator='\n')
+    writer.writerow(generator.headers)
+    writer.writerows(generator.rows(rows))
+    reader = csv.reader(buff.getvalue().splitlines())
+    headers = [header.replace('/', '_') for header in next(reader)]
+    return headers, list(reader)
+
+
+def _throughput(encode, lines):
+    # type: ('Callable[[list[str]], str]', list[list[str]]) -> float
+    start = time.perf_counter()
+    for line in lines:
+        encode(line)
+    return len(lines) / (time.perf_counter() - start)
+
+
+def _later_usage_filter(headers, lines):
+    # type: (list[str], list[list[str]]) -> 'Callable[[ColumnBatch], list[bool]]'
+    idx = headers.index('lineItem_UsageStartDate')
+    hours = sorted(set(line[idx] for line in lines))
+    first_kept = hours[len(hours) // 2]
+    return lambda batch: [start >= first_kept for start in batch.column('lineItem_UsageStartDate')]
+
+
+def _held_rows_allocations(parse, lines):
+    # type: ('Callable[[list[str]], dict]', list[list[str]]) -> (int, int)
+    tracemalloc.start()
+    # copy the cells while tracing, like csv.reader allocates them for every line
+    rows = [parse([''.join(tab) for tab in line]) for line in lines]
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del rows
+    stats = snapshot.statistics('filename')
+    return sum(stat.count for stat in stats), sum(stat.size for stat in stats)
+
+
+def run_encoding_benchmark(rows, tag_columns):
+    # type: (int, int) -> list[dict]
+    headers, lines = _csv_rows(rows, tag_columns)
+    event_time = EVENT_TIME.strftime('%Y-%m-%d %H:%M:%S')
+    fields_parser = get_fields_parser()
+
+    for line in lines[:100]:
+        expected = json.dumps(_parse_file(headers, line, event_time))
+        if RowEncoder(headers, event_time, fields_parser).encode(line) != expected:
+            raise AssertionError("RowEncoder output differs from json.dumps(_parse_file(...))")
+    if list(RowEncoder(headers, event_time, fields_parser).encode_rows(lines[:100])) != \
+            [RowEncoder(headers, event_time, fields_parser).encode(line) for line in lines[:100]]:
+        raise AssertionError("RowEncoder.encode_rows() output differs from RowEncoder.encode()")
+
+    results = []
+    for name, make_encode, make_parse in [
+        ('json-dumps-per-row',
+         lambda: lambda line: json.dumps(_parse_file(headers, line, event_time)),
+         lambda: lambda line: _parse_file(headers, line, event_time)),
+        ('row-encoder',
+         lambda: RowEncoder(headers, event_time, fields_parser).encode,
+         lambda: RowEncoder(headers, event_time, fields_parser).parse),
+    ]:
+        blocks, size = _held_rows_allocations(make_parse(), lines)
+        results.append({
+            'scenario': "encoding-{}".format(name),
+            'rows': rows,
+            'columns': len(headers),
+            'rows_per_sec': _throughput(make_encode(), lines),
+            'held_rows_blocks': blocks,
+            'held_rows_bytes': size,
+        })
+
+    later_usage = _later_usage_filter(headers, lines)
+    for name, row_filter in [('row-encoder-batch', None), ('row-encoder-batch-filtered', later_usage)]:
+        encoder = RowEncoder(headers, event_time, fields_parser)
+        start = time.perf_counter()
+        shipped = sum(1 for _ in encoder.encode_rows(lines, row_filter))
+        results.append({
+            'scenario': "encoding-{}".format(name),
+            'rows': rows,
+            'columns': len(headers),
+            'rows_per_sec': len(lines) / (time.perf_counter() - start),
+            'rows_encoded': shipped,
+        })
+    return results
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--rows', type=int, default=50000, help="rows to encode (default: 50000)")
+    arg_parser.add_argument('--tag-columns', type=int, default=50, help="tag columns (default: 50)")
+    arg_parser.add_argument('--results-dir', default=DEFAULT_RESULTS_DIR, help="where to save the results file")
+    args = arg_parser.parse_args(argv)
+
+    results = run_encoding_benchmark(args.rows, args.tag_columns)
+    line = "{:<36} {:>12} {:>18} {:>16}"
+    print(line.format('scenario', 'rows/sec', 'held rows blocks', 'held rows MB'))
+    for r in results:
+        held_rows_mb = "{:.1f}".format(r['held_rows_bytes'] / (1024 * 1024)) if 'held_rows_bytes' in r else '-'
+        print(line.format(r['scenario'], "{:.0f}".format(r['rows_per_sec']), r.get('held_rows_blocks', '-'),
+                          held_rows_mb))
+    print("results saved to {}".format(save_results(results, args.results_dir)))
+
+
+if __name__ == '__main__':
+    main()
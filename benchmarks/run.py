@@ -0,0 +1,297 @@
+"""
+Benchmarks the full lambda_handler pipeline against synthetic CUR reports.
+
+Every scenario runs in its own process, so peak memory is measured per scenario.
+S3 is replaced by a local stand-in serving generated files from disk, and the
+Logz.io listener by a local HTTP server that counts what it receives, running
+in a process of its own so it isn't part of the measured memory.
+
+    python -m benchmarks.run --rows 100000
+    python -m benchmarks.run --scenario hourly-wide-tags --compare benchmarks/results/<previous>.json
+    python -m benchmarks.run --memory-budget-mb 64 --check-memory-ceiling
+    python -m benchmarks.run --listener-latency 0.2 --listener-fail-every 10
+    python -m benchmarks.run --scenario hourly-wide-tags --ship-window-days 3
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+from . import cur_generator
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_RESULTS_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'results')
+
+EVENT_TIME = datetime.datetime(2018, 2, 15, 12, 0, 0)
+BUCKET = 'benchmark-bucket'
+REPORT_PATH = 'benchmark/cur-report'
+REPORT_NAME = 'cur-report'
+
+SCENARIOS = {
+    'hourly-narrow': {'granularity': cur_generator.GRANULARITY_HOURLY, 'resource_ids': False, 'tag_columns': 0},
+    'hourly-resource-ids': {'granularity': cur_generator.GRANULARITY_HOURLY, 'resource_ids': True, 'tag_columns': 0},
+    'hourly-wide-tags': {'granularity': cur_generator.GRANULARITY_HOURLY, 'resource_ids': True, 'tag_columns': 50},
+    'monthly-narrow': {'granularity': cur_generator.GRANULARITY_MONTHLY, 'resource_ids': False, 'tag_columns': 0},
+}
+
+# the memory ceiling check runs every scenario again on a report this many times bigger
+CEILING_SCALE = 4
+# peak RSS may grow by this much on the bigger report (allocator noise, interned strings, ...)
+CEILING_TOLERANCE_KB = 8 * 1024
+CEILING_TOLERANCE_RATIO = 0.05
+
+
+def _peak_rss_kb():
+    # type: () -> int
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _manifest_key():
+    # type: () -> str
+    start, end = cur_generator.report_month_range(EVENT_TIME)
+    report_monthly_folder = "{:02d}{:02d}01-{:02d}{:02d}01".format(start.year, start.month, end.year, end.month)
+    return "{0}/{1}/{2}-Manifest.json".format(REPORT_PATH, report_monthly_folder, REPORT_NAME)
+
+
+def run_pipeline(report_files, listener_latency=0.0, listener_fail_every=0, ship_window_days=None):
+    # type: (list[str], float, int, int) -> dict
+    """
+    Runs lambda_handler over the given local report parts and returns the measurements.
+
+    With ship_window_days, a first run builds the report indexes and the
+    measurements are of the run after it.
+    """
+    import src.lambda_function as worker
+    from src.memory_budget import MemoryBudget
+    from .stand_ins import ListenerProcess, LocalS3Client
+
+    s3client = LocalS3Client()
+    report_keys = []
+    for idx, path in enumerate(report_files):
+        key = "{0}/assembly/{1}-{2}.csv.gz".format(REPORT_PATH, REPORT_NAME, idx + 1)
+        s3client.put_file(BUCKET, key, path)
+        report_keys.append(key)
+    s3client.put_manifest(BUCKET, _manifest_key(), report_keys)
+
+    env_var = {
+        'TOKEN': 'benchmark-token',
+        'S3_BUCKET_NAME': BUCKET,
+        'REPORT_PATH': REPORT_PATH,
+        'REPORT_NAME': REPORT_NAME,
+    }
+    if ship_window_days:
+        env_var['SHIP_WINDOW_DAYS'] = str(ship_window_days)
+    event = {'time': EVENT_TIME.strftime('%Y-%m-%d %H:%M:%S')}
+
+    rss_before_kb = _peak_rss_kb()
+    with mock.patch.dict(os.environ, env_var), mock.patch.object(worker.boto3, 'client', return_value=s3client):
+        # the budget the function derives from MEMORY_BUDGET_MB or the Lambda memory
+        budget = MemoryBudget.from_environment()
+        if ship_window_days:
+            with ListenerProcess() as listener:
+                os.environ['URL'] = listener.url
+                worker.lambda_handler(event, None)
+
+        with ListenerProcess(latency=listener_latency, fail_every=listener_fail_every) as listener:
+            os.environ['URL'] = listener.url
+            start = time.perf_counter()
+            worker.lambda_handler(event, None)
+            elapsed = time.perf_counter() - start
+
+    return {
+        'seconds': elapsed,
+        'peak_rss_kb': _peak_rss_kb(),
+        'rss_before_pipeline_kb': rss_before_kb,
+        'memory_budget_kb': budget.budget_in_bytes // 1024,
+        'requests': listener.requests,
+        'failed_requests': listener.failed_requests,
+        'max_requests_in_flight': listener.max_in_flight,
+        'logs_shipped': listener.logs_received,
+        'bytes_shipped': listener.bytes_received,
+        'bytes_shipped_uncompressed': listener.bytes_uncompressed,
+    }
+
+
+def _generate(scenario, rows, parts, work_dir):
+    # type: (str, int, int, str) -> (list[str], dict)
+    config = SCENARIOS[scenario]
+    files, raw_bytes, columns = [], 0, 0
+    for part in range(parts):
+        path = os.path.join(work_dir, "{0}-{1}.csv.gz".format(scenario, part + 1))
+        meta = cur_generator.write_report(path, rows // parts, EVENT_TIME, seed=part, **config)
+        files.append(path)
+        raw_bytes += meta['raw_bytes']
+        columns = meta['columns']
+
+    return files, {'rows': rows // parts * parts, 'columns': columns, 'raw_bytes': raw_bytes,
+                   'compressed_bytes': sum(os.path.getsize(f) for f in files)}
+
+
+def run_scenario(scenario, rows, parts, work_dir, memory_budget_mb=None, listener_latency=0.0,
+                 listener_fail_every=0, ship_window_days=0):
+    # type: (str, int, int, str, float, float, int, int) -> dict
+    files, meta = _generate(scenario, rows, parts, work_dir)
+    env = dict(os.environ)
+    if memory_budget_mb:
+        env['MEMORY_BUDGET_MB'] = str(memory_budget_mb)
+    child = subprocess.run([sys.executable, '-m', 'benchmarks.run',
+                            '--listener-latency', str(listener_latency),
+                            '--listener-fail-every', str(listener_fail_every),
+                            '--ship-window-days', str(ship_window_days),
+                            '--child'] + files,
+                           cwd=ROOT_DIR, env=env, stdout=subprocess.PIPE, check=True)
+    measured = json.loads(child.stdout.decode('utf-8').splitlines()[-1])
+    for f in files:
+        os.remove(f)
+
+    result = dict(scenario=scenario, parts=parts, memory_budget_mb=memory_budget_mb,
+                  listener_latency=listener_latency, listener_fail_every=listener_fail_every,
+                  ship_window_days=ship_window_days, **meta)
+    result.update(measured)
+    result['rows_per_sec'] = meta['rows'] / measured['seconds']
+    result['mb_per_sec'] = meta['raw_bytes'] / (1024 * 1024) / measured['seconds']
+    return result
+
+
+def check_memory_ceiling(results):
+    # type: (list[dict]) -> bool
+    """
+    Checks that the pipeline stays within its memory budget, on a report and on a bigger one.
+
+    Peak RSS growing with the report is reported, but not a failure by itself: a
+    report too small to fill the pending bulks peaks lower than a bigger one,
+    while both are bounded by the budget.
+    """
+    by_scenario = {}
+    for r in results:
+        by_scenario.setdefault(r['scenario'], []).append(r)
+
+    ok = True
+    for scenario, runs in sorted(by_scenario.items()):
+        small, large = sorted(runs, key=lambda r: r['rows'])
+        allowed_kb = small['peak_rss_kb'] + max(CEILING_TOLERANCE_KB, small['peak_rss_kb'] * CEILING_TOLERANCE_RATIO)
+        flat = large['peak_rss_kb'] <= allowed_kb
+        pipeline_kb = max(r['peak_rss_kb'] - r['rss_before_pipeline_kb'] for r in runs)
+        within = all(r['peak_rss_kb'] - r['rss_before_pipeline_kb'] <= r['memory_budget_kb'] for r in runs)
+        if not within:
+            status = 'CEILING EXCEEDED'
+        else:
+            status = 'OK' if flat else 'OK (grew with the report, within the budget)'
+        print("{:<22} peak RSS {:.1f} MB at {} rows, {:.1f} MB at {} rows, pipeline {:.1f} MB of {:.0f} MB: {}".format(
+            scenario, small['peak_rss_kb'] / 1024, small['rows'], large['peak_rss_kb'] / 1024, large['rows'],
+            pipeline_kb / 1024, large['memory_budget_kb'] / 1024, status))
+        ok = ok and within
+    return ok
+
+
+def _git_revision():
+    # type: () -> str
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save_results(results, results_dir):
+    # type: (list[dict], str) -> str
+    from src.shipper import VERSION
+
+    created = datetime.datetime.utcnow()
+    revision = _git_revision()
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, "{0}-{1}-{2}.json".format(VERSION, revision,
+                                                               created.strftime('%Y%m%dT%H%M%S')))
+    with open(path, 'w') as f:
+        json.dump({
+            'version': VERSION,
+            'revision': revision,
+            'created': created.isoformat(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'results': results,
+        }, f, indent=2)
+    return path
+
+
+def print_results(results, baseline=None):
+    # type: (list[dict], dict) -> None
+    baseline = baseline or {}
+    previous_version, previous_revision = baseline.get('version'), baseline.get('revision')
+    # with --check-memory-ceiling every scenario runs at two sizes
+    baseline = {(r['scenario'], r['rows']): r for r in baseline.get('results', [])}
+    line = "{:<22} {:>9} {:>8} {:>12} {:>9} {:>13} {:>14}"
+    print(line.format('scenario', 'rows', 'columns', 'rows/sec', 'MB/sec', 'peak RSS MB', 'shipped MB'))
+    for r in results:
+        print(line.format(r['scenario'], r['rows'], r['columns'], "{:.0f}".format(r['rows_per_sec']),
+                          "{:.2f}".format(r['mb_per_sec']), "{:.1f}".format(r['peak_rss_kb'] / 1024),
+                          "{:.2f}".format(r['bytes_shipped'] / (1024 * 1024))))
+        previous = baseline.get((r['scenario'], r['rows']))
+        if previous:
+            print("  vs. {} {}: rows/sec {:+.1f}%, peak RSS {:+.1f}%".format(
+                previous_version, previous_revision,
+                (r['rows_per_sec'] / previous['rows_per_sec'] - 1) * 100,
+                (r['peak_rss_kb'] / previous['peak_rss_kb'] - 1) * 100))
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                            help="scenario to run, can be repeated (default: all)")
+    arg_parser.add_argument('--rows', type=int, default=50000, help="rows per scenario (default: 50000)")
+    arg_parser.add_argument('--parts', type=int, default=1, help="report parts in the manifest (default: 1)")
+    arg_parser.add_argument('--results-dir', default=DEFAULT_RESULTS_DIR, help="where to save the results file")
+    arg_parser.add_argument('--compare', metavar='RESULTS_FILE', help="previous results file to compare against")
+    arg_parser.add_argument('--memory-budget-mb', type=float,
+                            help="MEMORY_BUDGET_MB for the pipeline (default: derived from the Lambda memory)")
+    arg_parser.add_argument('--check-memory-ceiling', action='store_true',
+                            help="also run every scenario on a {}x bigger report and fail if the pipeline "
+                                 "goes over its memory budget"
+                            .format(CEILING_SCALE))
+    arg_parser.add_argument('--listener-latency', type=float, default=0.0,
+                            help="seconds the listener stand-in waits before answering a bulk")
+    arg_parser.add_argument('--listener-fail-every', type=int, default=0,
+                            help="answer every n-th bulk with 429 to exercise throttling (default: never)")
+    arg_parser.add_argument('--ship-window-days', type=int, default=0,
+                            help="SHIP_WINDOW_DAYS for the pipeline, measured on the run after the one "
+                                 "building the report indexes (default: ship everything)")
+    arg_parser.add_argument('--child', nargs='+', metavar='REPORT_FILE', help=argparse.SUPPRESS)
+    args = arg_parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_pipeline(args.child, args.listener_latency, args.listener_fail_every,
+                                      args.ship_window_days)))
+        return
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for scenario in args.scenario or sorted(SCENARIOS):
+            options = {'listener_latency': args.listener_latency, 'listener_fail_every': args.listener_fail_every,
+                        'ship_window_days': args.ship_window_days}
+            results.append(run_scenario(scenario, args.rows, args.parts, work_dir, args.memory_budget_mb, **options))
+            if args.check_memory_ceiling:
+                results.append(run_scenario(scenario, args.rows * CEILING_SCALE, args.parts, work_dir,
+                                            args.memory_budget_mb, **options))
+
+    print_results(results, baseline)
+    print("results saved to {}".format(save_results(results, args.results_dir)))
+    if args.check_memory_ceiling and not check_memory_ceiling(results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
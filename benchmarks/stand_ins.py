@@ -0,0 +1,195 @@
+import gzip
+import hashlib
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+
+class LocalS3Client(object):
+    """ Minimal stand-in for the boto3 S3 client calls made by the lambda function """
+
+    class exceptions(object):
+        class NoSuchKey(ClientError):
+            def __init__(self, key):
+                super(LocalS3Client.exceptions.NoSuchKey, self).__init__(
+                    {'Error': {'Code': 'NoSuchKey', 'Message': key}}, 'GetObject')
+
+    def __init__(self):
+        self._objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        # type: (str, str, 'bytes|str') -> None
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        self._objects[(Bucket, Key)] = Body
+
+    def put_file(self, Bucket, Key, path):
+        # type: (str, str, str) -> None
+        # keep only the path so big reports are read from disk, like a streamed S3 body
+        self._objects[(Bucket, Key)] = os.path.abspath(path)
+
+    def put_manifest(self, Bucket, Key, report_keys):
+        # type: (str, str, list[str]) -> None
+        self.put_object(Bucket, Key, json.dumps({'reportKeys': report_keys}))
+
+    def get_object(self, Bucket, Key):
+        # type: (str, str) -> dict
+        try:
+            obj = self._objects[(Bucket, Key)]
+        except KeyError:
+            raise LocalS3Client.exceptions.NoSuchKey(Key)
+
+        if isinstance(obj, bytes):
+            return {'Body': io.BytesIO(obj), 'ContentLength': len(obj),
+                    'ETag': '"{}"'.format(hashlib.md5(obj).hexdigest())}
+        # an ETag that changes with the file, without reading it
+        stat = os.stat(obj)
+        return {'Body': open(obj, 'rb'), 'ContentLength': stat.st_size,
+                'ETag': '"{0:x}-{1:x}"'.format(stat.st_size, stat.st_mtime_ns)}
+
+
+class _ListenerHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        status = self.server.stand_in.handle(body)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ListenerStandIn(object):
+    """
+    Local HTTP server that accepts bulks the way the Logz.io listener does and counts them.
+
+    latency delays every response, and every fail_every-th request is answered
+    with fail_status instead of being accepted, to exercise throttling and retries.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, fail_every=0, fail_status=429):
+        # type: (str, int, float, int, int) -> None
+        self._server = http.server.ThreadingHTTPServer((host, port), _ListenerHandler)
+        self._server.daemon_threads = True
+        self._server.stand_in = self
+        self._thread = None
+        self._lock = threading.Lock()
+        self.latency = latency
+        self.fail_every = fail_every
+        self.fail_status = fail_status
+        self.requests = 0
+        self.failed_requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.bytes_received = 0
+        self.bytes_uncompressed = 0
+        self.logs_received = 0
+
+    @property
+    def url(self):
+        # type: () -> str
+        host, port = self._server.server_address[:2]
+        return "http://{0}:{1}".format(host, port)
+
+    def handle(self, body):
+        # type: (bytes) -> int
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            fail = self.fail_every and self.requests % self.fail_every == 0
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            if fail:
+                with self._lock:
+                    self.failed_requests += 1
+                return self.fail_status
+            self.record(body)
+            return 200
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def record(self, body):
+        # type: (bytes) -> None
+        data = gzip.decompress(body)
+        with self._lock:
+            self.bytes_received += len(body)
+            self.bytes_uncompressed += len(data)
+            self.logs_received += data.count(b'\n') + 1
+
+    def stats(self):
+        # type: () -> dict
+        with self._lock:
+            return {name: getattr(self, name) for name in ListenerProcess.STATS}
+
+    def start(self):
+        # type: () -> ListenerStandIn
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        # type: () -> None
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def _serve_listener(conn, latency, fail_every, fail_status):
+    # type: ('multiprocessing.connection.Connection', float, int, int) -> None
+    with ListenerStandIn(latency=latency, fail_every=fail_every, fail_status=fail_status) as listener:
+        conn.send(listener.url)
+        conn.recv()
+    conn.send(listener.stats())
+
+
+class ListenerProcess(object):
+    """
+    ListenerStandIn running in its own process, so receiving and decompressing
+    bulks doesn't count in the memory of the pipeline being measured.
+
+    The counters are only available once it is stopped.
+    """
+    STATS = ('requests', 'failed_requests', 'max_in_flight', 'bytes_received', 'bytes_uncompressed',
+             'logs_received')
+
+    def __init__(self, latency=0.0, fail_every=0, fail_status=429):
+        # type: (float, int, int) -> None
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve_listener,
+                                                args=(child_conn, latency, fail_every, fail_status), daemon=True)
+        self.url = None
+
+    def start(self):
+        # type: () -> ListenerProcess
+        self._process.start()
+        self.url = self._conn.recv()
+        return self
+
+    def stop(self):
+        # type: () -> None
+        self._conn.send(None)
+        for name, value in self._conn.recv().items():
+            setattr(self, name, value)
+        self._process.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -1,5 +1,7 @@
 import boto3
+import codecs
 import csv
+import datetime
 import dateutil.relativedelta
 import json
 import logging
@@ -7,44 +9,142 @@ import os
 import zlib
 
 from dateutil import parser
-from .shipper import LogzioShipper
+from .memory_budget import MemoryBudget
+from .report_index import USAGE_START_COLUMN, USAGE_TIME_FORMAT, index_rows, load_report_index, ranged_rows, \
+    usage_window_filter
+from .row_encoder import RowEncoder
+from .schema import _parse_float, _parse_int, demote_fallbacks, load_schema
+from .shipper import AdaptiveController, LogzioShipper
+from .store import S3Store
 
 # Set logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# report schemas by header signature, kept while the Lambda container is warm
+_schema_cache = {}
+
 
 class CSVLineGenerator(object):
-    def __init__(self, csv_like_obj_body, line_delimiter='\n'):
+    READ_CHUNK_SIZE = 64 * 1024
+    DECOMPRESSED_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, csv_like_obj_body, line_delimiter='\n', read_chunk_size=None, decompressed_chunk_size=None,
+                 gzipped=True):
         self._obj_body = csv_like_obj_body
         self._line_delimiter = line_delimiter
-        self._dec = zlib.decompressobj(16 + zlib.MAX_WBITS)
-        self._buff = ''
+        self._dec = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        # compressed reads go to the same buffer, and every decompress call is capped,
+        # so memory does not depend on the report size or its compression ratio
+        self._read_buff = bytearray(read_chunk_size or self.READ_CHUNK_SIZE)
+        self._read_view = memoryview(self._read_buff)
+        self._decompressed_chunk_size = decompressed_chunk_size or self.DECOMPRESSED_CHUNK_SIZE
+        self._lines = []
+        self._line_idx = 0
+        self._partial_line = ''
+        self._eof = False
+        # decompressed bytes handed to the decoder so far
+        self._decompressed_bytes = 0
         self.headers = next(self.stream_line()).replace('/', '_')
 
+    def _read_compressed(self):
+        # type: () -> 'bytes|memoryview'
+        readinto = getattr(self._obj_body, 'readinto', None)
+        if readinto is None:
+            return self._obj_body.read(len(self._read_buff))
+        return self._read_view[:readinto(self._read_buff)]
+
+    def _next_data(self):
+        # type: () -> 'bytes|memoryview'
+        if self._dec is None:
+            data = self._read_compressed()
+            self._eof = not data
+            return data
+
+        data = self._dec.unconsumed_tail
+        if not data:
+            data = self._read_compressed()
+            if not data:
+                self._eof = True
+                return self._dec.flush()
+        return self._dec.decompress(data, self._decompressed_chunk_size)
+
+    def _next_text(self):
+        # type: () -> str
+        data = self._next_data()
+        self._decompressed_bytes += len(data)
+        return self._decoder.decode(data, final=self._eof)
+
+    @property
+    def decompressed_bytes(self):
+        # type: () -> int
+        return self._decompressed_bytes
+
+    @property
+    def offset(self):
+        # type: () -> int
+        """ Decompressed byte offset of the next line """
+        # only the text waiting to be yielded is encoded again, so this is cheap between chunks
+        pending = self._lines[self._line_idx:]
+        pending_bytes = sum(len(line.encode('utf-8')) for line in pending) + len(pending) * len(self._line_delimiter)
+        pending_bytes += len(self._partial_line.encode('utf-8')) + len(self._decoder.getstate()[0])
+        return self._decompressed_bytes - pending_bytes
+
+    def skip_to(self, offset):
+        # type: (int) -> None
+        """
+        Skips the lines before offset, a decompressed byte offset at the start of a line.
+
+        Gzip streams can't be seeked, the report is still decompressed up to offset,
+        but that text is dropped without being decoded or split into lines.
+        """
+        position = self.offset
+        while position < offset and self._line_idx < len(self._lines):
+            position += len(self._lines[self._line_idx].encode('utf-8')) + len(self._line_delimiter)
+            self._line_idx += 1
+        if position >= offset:
+            if position > offset:
+                raise ValueError("Offset {} is not at the start of a line".format(offset))
+            return
+
+        skip = offset - self._decompressed_bytes
+        if skip < 0:
+            raise ValueError("Offset {} is not at the start of a line".format(offset))
+        self._lines, self._line_idx, self._partial_line = [], 0, ''
+        self._decoder.reset()
+        data = b''
+        while skip >= 0 and not self._eof:
+            data = self._next_data()
+            self._decompressed_bytes += len(data)
+            skip -= len(data)
+        if skip > 0:
+            raise ValueError("Offset {} is past the end of the report".format(offset))
+        lines = self._decoder.decode(data[len(data) + skip:], final=self._eof).split(self._line_delimiter)
+        self._partial_line = lines.pop()
+        self._lines = lines
+
     def stream_line(self):
         # type: (CSVLineGenerator) -> 'Generator'
 
-        def _get_next_line():
-            # search for new line
-            endline_idx = self._buff.index(self._line_delimiter)
-            next_line = self._buff[:endline_idx]
-            self._buff = self._buff[endline_idx + 1:]
-            return next_line
-
-        def reader(stream):
+        def reader():
             while True:
-                try:
-                    yield _get_next_line()
+                if self._line_idx < len(self._lines):
+                    self._line_idx += 1
+                    yield self._lines[self._line_idx - 1]
                     continue
-                # no new line
-                except ValueError:
-                    self._buff += self._dec.decompress(stream.read(1024)).decode('utf-8')
                 # EOF
-                if not self._buff:
+                if self._eof:
+                    if self._partial_line:
+                        self._partial_line, last_line = '', self._partial_line
+                        yield last_line
                     break
+                # no new line
+                lines = (self._partial_line + self._next_text()).split(self._line_delimiter)
+                self._partial_line = lines.pop()
+                self._lines, self._line_idx = lines, 0
 
-        return reader(self._obj_body)
+        return reader()
 
 
 def _download_manifest_file(obj):
@@ -54,20 +154,6 @@ def _download_manifest_file(obj):
     return json_content
 
 
-def _parse_float(s):
-    try:
-        return float(s)
-    except ValueError:
-        return s
-
-
-def _parse_int(s):
-    try:
-        return int(s)
-    except ValueError:
-        return s
-
-
 def get_fields_parser():
     # type: () -> dict
     return {
@@ -104,6 +190,77 @@ def _parse_file(headers, line, event_time):
     return row
 
 
+def _report_rows(gen):
+    # type: (CSVLineGenerator) -> (list[str], 'Iterator[list[str]]')
+    headers = next(csv.reader([gen.headers]))
+    return headers, csv.reader(gen.stream_line())
+
+
+def _ship_rows(headers, rows, shipper, event_time, fields_parser, store=None, row_filter=None, batch_rows=None,
+               whole_report=True):
+    # type: (list[str], 'Iterator[list[str]]', LogzioShipper, str, dict, object, 'Callable', int, bool) -> None
+    schema, rows = load_schema(headers, rows, fields_parser, store, _schema_cache, whole_report)
+    encoder = RowEncoder(headers, event_time, schema.fields_parser(fields_parser))
+    # columns learned while the rows are read are converted from the chunk they were learned from on
+    schema.on_learned = encoder.set_parser
+    # rows are encoded in column chunks, row_filter drops rows from a chunk before they are encoded
+    for json_log in encoder.encode_rows(rows, row_filter, batch_rows):
+        shipper.add_json(json_log)
+
+    shipper.flush()
+    schema.on_learned = None
+    demote_fallbacks(schema, store, _schema_cache)
+
+
+def _ship_window_start(event_time):
+    # type: (str) -> 'str|None'
+    """ Start of the usage shipped with SHIP_WINDOW_DAYS set, midnight that many days before the event """
+    days = int(os.environ.get('SHIP_WINDOW_DAYS') or 0)
+    if days <= 0:
+        return None
+    start = parser.parse(event_time) - datetime.timedelta(days=days)
+    return start.replace(hour=0, minute=0, second=0, microsecond=0).strftime(USAGE_TIME_FORMAT)
+
+
+def _ship_report(s3client, bucket, key, shipper, event_time, fields_parser, budget, store=None, window_start=None):
+    # type: ('boto3.client', str, str, LogzioShipper, str, dict, MemoryBudget, object, str) -> None
+    csv_like_obj = s3client.get_object(Bucket=bucket, Key=key)
+    etag = csv_like_obj.get('ETag')
+    index = load_report_index(store, key, etag) if window_start else None
+    ranges = index.ranges(window_start) if index else None
+    if index and not ranges:
+        csv_like_obj['Body'].close()
+        logger.info("Skipping {0}: no usage since {1}".format(key, window_start))
+        return
+
+    gen = CSVLineGenerator(csv_like_obj['Body'], read_chunk_size=budget.read_chunk_size,
+                           decompressed_chunk_size=budget.decompressed_chunk_size)
+    headers, rows = _report_rows(gen)
+    row_filter = None
+    if window_start and USAGE_START_COLUMN in headers:
+        if index:
+            logger.info("Reading {0} of the {1} rows of {2}: the others have no usage since {3}".format(
+                sum(count for _, count in ranges), sum(block[3] for block in index.blocks), key, window_start))
+            rows = ranged_rows(rows, gen, ranges)
+        else:
+            rows = index_rows(rows, gen, headers, key, etag, store)
+        row_filter = usage_window_filter(window_start)
+    _ship_rows(headers, rows, shipper, event_time, fields_parser, store, row_filter, budget.batch_rows(len(headers)),
+               whole_report=not index)
+
+
+def _create_shipper(logzio_url, budget):
+    # type: (str, MemoryBudget) -> LogzioShipper
+    controller = AdaptiveController(budget.bulk_size_in_bytes, budget.pending_bulks,
+                                    initial_bulk_size_in_bytes=budget.bulk_size_in_bytes)
+    return LogzioShipper(logzio_url, budget.bulk_size_in_bytes, budget.pending_bulks, controller)
+
+
+def _cache_store(s3client, env_var):
+    # type: ('boto3.client', dict) -> S3Store
+    return S3Store(s3client, env_var['bucket'], "{}/logzio-cache".format(env_var['report_path'].rstrip('/')))
+
+
 def _environment_variables():
     # type: () -> dict
     env_var = {
@@ -174,14 +331,18 @@ def lambda_handler(event, context):
         logger.error("Could not find latest report that is in the Manifest file")
         raise
 
-    shipper = LogzioShipper(logzio_url)
-    for key in latest_csv_keys:
-        logger.info("parsing the following report: {}".format(key))
-        csv_like_obj = s3client.get_object(Bucket=env_var['bucket'], Key=key)
-        gen = CSVLineGenerator(csv_like_obj['Body'])
-        headers = next(csv.reader([gen.headers]))
-        for line in gen.stream_line():
-            list_line = csv.reader([line])
-            shipper.add(_parse_file(headers, next(list_line), event_time))
-
-        shipper.flush()
+    budget = MemoryBudget.from_environment()
+    shipper = _create_shipper(logzio_url, budget)
+    fields_parser = get_fields_parser()
+    store = _cache_store(s3client, env_var)
+    window_start = _ship_window_start(event_time)
+    if window_start:
+        logger.info("Shipping the usage since {}".format(window_start))
+    try:
+        for key in latest_csv_keys:
+            logger.info("parsing the following report: {}".format(key))
+            _ship_report(s3client, env_var['bucket'], key, shipper, event_time, fields_parser, budget, store,
+                         window_start)
+    finally:
+        shipper.close()
+        logger.info("Run summary: {}".format(json.dumps(shipper.summary())))
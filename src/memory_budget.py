@@ -0,0 +1,90 @@
+import logging
+import os
+
+# set logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MB = 1024 * 1024
+
+
+class MemoryBudget(object):
+    """
+    Splits a hard memory budget between the pipeline stages.
+
+    The budget covers the buffers that grow with the report: the decompressed
+    text waiting to be split into lines, the batch of rows being encoded and
+    the bulks waiting to be sent. Everything else (interpreter, boto3, the
+    column dictionaries) is covered by the share of the Lambda memory that is
+    left out of the budget.
+    """
+    # fraction of the Lambda memory setting that the pipeline buffers may use
+    LAMBDA_MEMORY_RATIO = 0.5
+    DEFAULT_LAMBDA_MEMORY_MB = 1024
+    MIN_BUDGET_MB = 16
+
+    # a bulk is held as json strings, then joined, encoded and compressed before sending
+    BULK_MEMORY_FACTOR = 3
+    # upper bound for the adaptive bulk size, the listener accepts bulks of up to 10 MB
+    MAX_BULK_SIZE_IN_BYTES = 4 * MB
+    MAX_PENDING_BULKS = 8
+
+    # a batch cell is held as its csv string, in a column tuple, as a json fragment and in its joined row
+    BATCH_BYTES_PER_CELL = 256
+    MIN_BATCH_ROWS = 64
+    MAX_BATCH_ROWS = 1024
+
+    READ_CHUNK_SIZE = 64 * 1024
+    MIN_DECOMPRESSED_CHUNK_SIZE = 64 * 1024
+    MAX_DECOMPRESSED_CHUNK_SIZE = 4 * MB
+
+    def __init__(self, budget_in_bytes):
+        # type: (int) -> None
+        self.budget_in_bytes = max(budget_in_bytes, self.MIN_BUDGET_MB * MB)
+
+    @classmethod
+    def from_environment(cls):
+        # type: () -> MemoryBudget
+        """ MEMORY_BUDGET_MB if set, otherwise a share of the memory the Lambda function runs with """
+        try:
+            budget_mb = float(os.environ['MEMORY_BUDGET_MB'])
+        except KeyError:
+            lambda_memory_mb = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', cls.DEFAULT_LAMBDA_MEMORY_MB))
+            budget_mb = lambda_memory_mb * cls.LAMBDA_MEMORY_RATIO
+
+        budget = cls(int(budget_mb * MB))
+        logger.info("Memory budget: {0} MB ({1} pending bulks of {2} bytes, {3} bytes decompressed chunks)"
+                    .format(budget.budget_in_bytes // MB, budget.pending_bulks, budget.bulk_size_in_bytes,
+                            budget.decompressed_chunk_size))
+        return budget
+
+    @property
+    def decompressed_chunk_size(self):
+        # type: () -> int
+        # the chunk is held twice while it is split into lines
+        chunk = self.budget_in_bytes // 8 // 2
+        return min(max(chunk, self.MIN_DECOMPRESSED_CHUNK_SIZE), self.MAX_DECOMPRESSED_CHUNK_SIZE)
+
+    @property
+    def read_chunk_size(self):
+        # type: () -> int
+        return self.READ_CHUNK_SIZE
+
+    @property
+    def bulk_size_in_bytes(self):
+        # type: () -> int
+        return min(self.MAX_BULK_SIZE_IN_BYTES, self.budget_in_bytes // 32)
+
+    @property
+    def pending_bulks(self):
+        # type: () -> int
+        """ How many bulks may wait for the sender besides the one being filled """
+        bulks_budget = self.budget_in_bytes // 2
+        bulks = bulks_budget // (self.bulk_size_in_bytes * self.BULK_MEMORY_FACTOR) - 1
+        return min(max(bulks, 1), self.MAX_PENDING_BULKS)
+
+    def batch_rows(self, columns):
+        # type: (int) -> int
+        """ How many rows of a report with that many columns are encoded at once """
+        rows = self.budget_in_bytes // 16 // (max(columns, 1) * self.BATCH_BYTES_PER_CELL)
+        return min(max(rows, self.MIN_BATCH_ROWS), self.MAX_BATCH_ROWS)
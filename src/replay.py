@@ -0,0 +1,279 @@
+"""
+Replays local Cost and Usage report files through the lambda function pipeline.
+
+Reports can be .csv.gz, .zip, .csv or Parquet files, or a directory holding a
+<report name>-Manifest.json and its report parts (for example, a synced copy of
+the report's S3 folder). Rows are shipped to a listener URL, written to disk
+as gzipped bulk files, or dropped with --output /dev/null to benchmark parsing.
+
+    python -m src.replay --output https://listener.logz.io:8071 --token <token> 20180201-20180301/
+    python -m src.replay --output /dev/null --profile replay.prof report-1.csv.gz
+"""
+import argparse
+import contextlib
+import cProfile
+import datetime
+import gzip
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import zipfile
+
+from .lambda_function import CSVLineGenerator, _create_shipper, _report_rows, _ship_rows, get_fields_parser
+from .memory_budget import MemoryBudget
+from .shipper import LogzioShipper
+from .store import FileStore
+
+REPORT_EXTENSIONS = ('.csv.gz', '.csv.zip', '.zip', '.csv', '.parquet')
+MANIFEST_SUFFIX = '-Manifest.json'
+PARQUET_BATCH_SIZE = 16 * 1024
+CUR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class BulkFileShipper(LogzioShipper):
+    """ Writes every bulk to its own gzipped file, as it would have been sent to the listener """
+
+    def __init__(self, directory, name, max_bulk_size_in_bytes=None, pending_bulks=0):
+        # type: (str, str, int, int) -> None
+        super(BulkFileShipper, self).__init__(directory, max_bulk_size_in_bytes, pending_bulks)
+        self._directory = directory
+        self._name = name
+        self._bulk_ids = itertools.count(1)
+
+    def _send_to_logzio(self, logs):
+        # type: (list[str]) -> None
+        compressed_data = gzip.compress(str.encode('\n'.join(logs)))
+        path = os.path.join(self._directory, "{0}-{1:05d}.json.gz".format(self._name, next(self._bulk_ids)))
+        with open(path, 'wb') as f:
+            f.write(compressed_data)
+        self._count_sent(logs, len(compressed_data))
+
+
+class NullShipper(LogzioShipper):
+    """ Drops every bulk, to measure reading, parsing and encoding alone """
+
+    def __init__(self):
+        super(NullShipper, self).__init__(os.devnull)
+
+    def _send_to_logzio(self, logs):
+        # type: (list[str]) -> None
+        self._count_sent(logs, sum(map(len, logs)))
+
+
+# Parquet reports name columns <category>_<snake_case_name>, the CSV reports the lambda function reads
+# name them <category>/<CamelCaseName> (<category>/<camelCaseName> for pricing and product)
+PARQUET_CATEGORIES = {
+    'identity': 'identity',
+    'bill': 'bill',
+    'line_item': 'lineItem',
+    'product': 'product',
+    'pricing': 'pricing',
+    'reservation': 'reservation',
+    'savings_plan': 'savingsPlan',
+    'discount': 'discount',
+    'split_line_item': 'splitLineItem',
+    'resource_tags': 'resourceTags',
+    'cost_category': 'costCategory',
+}
+# user defined names, kept as they are
+PARQUET_VERBATIM_CATEGORIES = ('resourceTags', 'costCategory')
+PARQUET_LOWER_CAMEL_CATEGORIES = ('pricing', 'product')
+PARQUET_NAME_EXCEPTIONS = {'product_product_name': 'product_ProductName'}
+
+
+def _parquet_header(name):
+    # type: (str) -> str
+    """ The header of a Parquet column in the CSV report, as the lambda function ships it """
+    name = name.replace('/', '_')
+    if name in PARQUET_NAME_EXCEPTIONS:
+        return PARQUET_NAME_EXCEPTIONS[name]
+    # longest category first, split_line_item before line_item
+    for prefix in sorted(PARQUET_CATEGORIES, key=len, reverse=True):
+        if not name.startswith(prefix + '_'):
+            continue
+        category, rest = PARQUET_CATEGORIES[prefix], name[len(prefix) + 1:]
+        if category in PARQUET_VERBATIM_CATEGORIES or rest != rest.lower():
+            return "{0}_{1}".format(category, rest)
+        words = [word[:1].upper() + word[1:] for word in rest.split('_')]
+        if category in PARQUET_LOWER_CAMEL_CATEGORIES:
+            words[0] = words[0].lower()
+        return "{0}_{1}".format(category, ''.join(words))
+    return name
+
+
+def _parquet_value(value):
+    # type: (object) -> str
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.strftime(CUR_TIME_FORMAT)
+    return str(value)
+
+
+def _parquet_rows(report):
+    # type: ('pyarrow.parquet.ParquetFile') -> 'Iterator[list[str]]'
+    for batch in report.iter_batches(batch_size=PARQUET_BATCH_SIZE):
+        columns = [[_parquet_value(value) for value in column.to_pylist()] for column in batch.columns]
+        for row in zip(*columns):
+            yield row
+
+
+@contextlib.contextmanager
+def _open_report(path, budget):
+    # type: (str, MemoryBudget) -> 'Iterator[(list[str], Iterator[list[str]])]'
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Reading Parquet reports requires pyarrow: pip install pyarrow")
+        report = pyarrow.parquet.ParquetFile(path)
+        yield [_parquet_header(header) for header in report.schema_arrow.names], _parquet_rows(report)
+        return
+
+    with contextlib.ExitStack() as stack:
+        if zipfile.is_zipfile(path):
+            archive = stack.enter_context(zipfile.ZipFile(path))
+            body, gzipped = stack.enter_context(archive.open(archive.namelist()[0])), False
+        else:
+            body, gzipped = stack.enter_context(open(path, 'rb')), path.endswith('.gz')
+        gen = CSVLineGenerator(body, read_chunk_size=budget.read_chunk_size,
+                               decompressed_chunk_size=budget.decompressed_chunk_size, gzipped=gzipped)
+        yield _report_rows(gen)
+
+
+def _manifest_reports(directory, manifest_path):
+    # type: (str, str) -> list[str]
+    with open(manifest_path) as f:
+        report_keys = json.load(f)['reportKeys']
+
+    reports = []
+    for key in report_keys:
+        # the keys are S3 keys, match the longest suffix of the key found under the directory
+        parts = key.split('/')
+        for i in range(len(parts)):
+            candidate = os.path.join(directory, *parts[i:])
+            if os.path.isfile(candidate):
+                reports.append(candidate)
+                break
+        else:
+            raise SystemExit("Report {0} of {1} was not found under {2}".format(key, manifest_path, directory))
+    return reports
+
+
+def resolve_reports(paths):
+    # type: (list[str]) -> list[str]
+    reports = []
+    for path in paths:
+        if not os.path.isdir(path):
+            reports.append(path)
+            continue
+
+        manifests = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(MANIFEST_SUFFIX))
+        if manifests:
+            for manifest in manifests:
+                reports.extend(_manifest_reports(path, manifest))
+            continue
+
+        for root, _, names in sorted(os.walk(path)):
+            reports.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(REPORT_EXTENSIONS))
+    return reports
+
+
+def _output_shipper(args, budget, name):
+    # type: (argparse.Namespace, MemoryBudget, str) -> LogzioShipper
+    if args.output.startswith(('http://', 'https://')):
+        logzio_url = "{0}/?token={1}&type=billing".format(args.output.rstrip('/'), args.token)
+        return _create_shipper(logzio_url, budget)
+    if args.output == os.devnull:
+        return NullShipper()
+    os.makedirs(args.output, exist_ok=True)
+    return BulkFileShipper(args.output, name, budget.bulk_size_in_bytes, budget.pending_bulks)
+
+
+def replay_report(task):
+    # type: ((int, str, argparse.Namespace)) -> dict
+    idx, path, args = task
+    budget = MemoryBudget(MemoryBudget.from_environment().budget_in_bytes // args.workers)
+    shipper = _output_shipper(args, budget, "{0}-{1}".format(idx, os.path.basename(path).split('.')[0]))
+    # with a single worker the whole replay is profiled by main()
+    profiler = cProfile.Profile() if args.profile and args.workers > 1 else None
+
+    start = time.perf_counter()
+    try:
+        if profiler:
+            profiler.enable()
+        with _open_report(path, budget) as (headers, rows):
+            store = FileStore(args.cache_dir) if args.cache_dir else None
+            _ship_rows(headers, rows, shipper, args.event_time, get_fields_parser(), store,
+                       batch_rows=budget.batch_rows(len(headers)))
+    finally:
+        if profiler:
+            profiler.disable()
+        shipper.close()
+    elapsed = time.perf_counter() - start
+
+    if profiler:
+        profiler.dump_stats("{0}.{1}".format(args.profile, idx))
+    summary = shipper.summary()
+    summary.update(report=path, seconds=elapsed)
+    return summary
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('reports', nargs='+', metavar='REPORT',
+                            help="report files, or directories with a manifest or report files")
+    arg_parser.add_argument('--output', required=True,
+                            help="listener URL, directory for gzipped bulk files, or {}".format(os.devnull))
+    arg_parser.add_argument('--token', default=os.environ.get('TOKEN', ''),
+                            help="Logz.io account token, when shipping to a listener (default: $TOKEN)")
+    arg_parser.add_argument('--event-time', default=datetime.datetime.utcnow().strftime(CUR_TIME_FORMAT),
+                            help="time the logs are stamped with (default: now)")
+    arg_parser.add_argument('--cache-dir',
+                            help="directory keeping the inferred report schemas between runs (default: none)")
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help="report files replayed in parallel, each by its own process (default: 1)")
+    arg_parser.add_argument('--profile', metavar='PROFILE_FILE',
+                            help="write cProfile stats, one file per report suffixed by its index with --workers > 1")
+    arg_parser.add_argument('--verbose', action='store_true', help="log every bulk")
+    args = arg_parser.parse_args(argv)
+    # the pipeline modules log at INFO level, filter on the handler
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.INFO if args.verbose else logging.WARNING)
+    logging.basicConfig(handlers=[handler])
+
+    reports = resolve_reports(args.reports)
+    if not reports:
+        raise SystemExit("No reports found in {}".format(', '.join(args.reports)))
+    args.workers = max(min(args.workers, len(reports)), 1)
+    tasks = [(idx, path, args) for idx, path in enumerate(reports)]
+
+    start = time.perf_counter()
+    if args.workers == 1:
+        profiler = cProfile.Profile() if args.profile else None
+        if profiler:
+            profiler.enable()
+        summaries = [replay_report(task) for task in tasks]
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+    else:
+        with multiprocessing.Pool(args.workers) as pool:
+            summaries = pool.map(replay_report, tasks)
+    elapsed = time.perf_counter() - start
+
+    for summary in summaries:
+        print("{0}: {1} rows in {2:.2f}s ({3:.0f} rows/sec), {4} bulks, {5} bytes".format(
+            summary['report'], summary['logs_sent'], summary['seconds'],
+            summary['logs_sent'] / summary['seconds'], summary['bulks_sent'], summary['bytes_sent']))
+    rows = sum(summary['logs_sent'] for summary in summaries)
+    print("total: {0} rows in {1:.2f}s ({2:.0f} rows/sec) with {3} worker(s)".format(
+        rows, elapsed, rows / elapsed, args.workers))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+import itertools
+import logging
+import operator
+
+# Set logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+USAGE_START_COLUMN = 'lineItem_UsageStartDate'
+USAGE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+PERIOD_START_COLUMN = 'bill_BillingPeriodStartDate'
+LINE_ITEM_TYPE_COLUMN = 'lineItem_LineItemType'
+USAGE_LINE_ITEM = 'Usage'
+
+
+class ReportIndex(object):
+    """
+    Sparse index of one report part, by the usage start of its rows.
+
+    The part is split in blocks of about BLOCK_SIZE_IN_BYTES of decompressed
+    text, each kept as the decompressed byte offset of its first row, the
+    latest lineItem_UsageStartDate of its rows, whether it holds rows shipped
+    whatever the window (see usage_window_filter) and its number of rows.
+    An index is only valid for the version of the part it was built from, the
+    one with the same S3 ETag.
+    """
+    BLOCK_SIZE_IN_BYTES = 8 * 1024 * 1024
+    # rows read between two checks of the block size
+    STEP_ROWS = 1024
+
+    def __init__(self, key, etag, blocks):
+        # type: (str, str, list[list]) -> None
+        self.key = key
+        self.etag = etag
+        # [offset, latest usage start, kept, rows] of every block, in the order of the part
+        self.blocks = blocks
+
+    def ranges(self, window_start):
+        # type: (str) -> list[list[int]]
+        """ [offset, rows] of every run of blocks with rows to ship in the window, empty when there is none """
+        ranges = []
+        previous = False
+        for offset, latest_start, kept, rows in self.blocks:
+            selected = kept or latest_start >= window_start
+            if selected and previous:
+                ranges[-1][1] += rows
+            elif selected:
+                ranges.append([offset, rows])
+            previous = selected
+        return ranges
+
+    def to_json(self):
+        # type: () -> dict
+        return {'key': self.key, 'etag': self.etag, 'blocks': self.blocks}
+
+    @classmethod
+    def from_json(cls, content):
+        # type: (dict) -> ReportIndex
+        return cls(content['key'], content['etag'], content['blocks'])
+
+
+def _index_name(key):
+    # type: (str) -> str
+    # named after the part file (<report name>-<part number>.csv.gz), not its whole key: every report
+    # version is delivered under a new assembly folder, and its index replaces the one of the previous version
+    return "index-{}.json".format(key.rsplit('/', 1)[-1])
+
+
+def load_report_index(store, key, etag):
+    # type: (object, str, str) -> 'ReportIndex|None'
+    """ The index of the part at key, None when there is none for this version of the part """
+    if store is None or not etag:
+        return None
+    content = store.get(_index_name(key))
+    if content is None or content.get('key') != key or content.get('etag') != etag:
+        return None
+    # indexes saved before blocks recorded their kept rows are built again
+    if any(len(block) != 4 for block in content['blocks']):
+        return None
+    return ReportIndex.from_json(content)
+
+
+def _kept_rows(usage_starts, period_starts, line_item_types):
+    # type: ('Iterable[str]', 'Iterable[str]|None', 'Iterable[str]|None') -> 'Iterator[bool]'
+    """ Whether each row is shipped whatever the window, the columns are None when the report does not have them """
+    kept = map(operator.eq, usage_starts, period_starts) if period_starts is not None else itertools.repeat(False)
+    if line_item_types is not None:
+        kept = map(operator.or_, kept, map(USAGE_LINE_ITEM.__ne__, line_item_types))
+    return kept
+
+
+def _step_column(step, column_idx):
+    # type: (list[list[str]], 'int|None') -> 'list[str]|None'
+    if column_idx is None:
+        return None
+    try:
+        return list(map(operator.itemgetter(column_idx), step))
+    except IndexError:
+        return [row[column_idx] if len(row) > column_idx else '' for row in step]
+
+
+def index_rows(rows, gen, headers, key, etag, store):
+    # type: ('Iterator[list[str]]', 'CSVLineGenerator', list[str], str, str, object) -> 'Iterator[list[str]]'
+    """ Yields the rows of a part read from its start, and saves its index once they were all read """
+    usage_idx = headers.index(USAGE_START_COLUMN)
+    period_idx = headers.index(PERIOD_START_COLUMN) if PERIOD_START_COLUMN in headers else None
+    type_idx = headers.index(LINE_ITEM_TYPE_COLUMN) if LINE_ITEM_TYPE_COLUMN in headers else None
+    blocks = []
+    block_offset, block_latest, block_kept, block_rows = gen.offset, '', False, 0
+    while True:
+        # rows are taken a step at a time, so gen.offset is where the row after the step starts
+        step = list(itertools.islice(rows, ReportIndex.STEP_ROWS))
+        if not step:
+            break
+        usage_starts = _step_column(step, usage_idx)
+        block_latest = max(block_latest, max(usage_starts))
+        block_kept = block_kept or any(_kept_rows(usage_starts, _step_column(step, period_idx),
+                                                  _step_column(step, type_idx)))
+        block_rows += len(step)
+        if gen.decompressed_bytes - block_offset >= ReportIndex.BLOCK_SIZE_IN_BYTES:
+            blocks.append([block_offset, block_latest, block_kept, block_rows])
+            block_offset, block_latest, block_kept, block_rows = gen.offset, '', False, 0
+        for row in step:
+            yield row
+
+    blocks.append([block_offset, block_latest, block_kept, block_rows])
+    if store is not None and etag:
+        store.put(_index_name(key), ReportIndex(key, etag, blocks).to_json())
+
+
+def ranged_rows(rows, gen, ranges):
+    # type: ('Iterator[list[str]]', 'CSVLineGenerator', list[list[int]]) -> 'Iterator[list[str]]'
+    """ Yields the rows of the ranges of ReportIndex.ranges(), skipping the text between them """
+    for offset, count in ranges:
+        gen.skip_to(offset)
+        for row in itertools.islice(rows, count):
+            yield row
+
+
+def usage_window_filter(window_start):
+    # type: (str) -> 'Callable[[ColumnBatch], Iterable[bool]]'
+    """
+    Row filter keeping the rows whose usage started within the window.
+
+    Line items dated at the start of the billing period (Tax, Fee, RIFee) and
+    the ones that are not usage (Credit, Refund) are revised by AWS until the
+    end of the month, they are kept whatever the window.
+    """
+    def within_window(batch):
+        usage_starts = batch.column(USAGE_START_COLUMN)
+        kept = _kept_rows(usage_starts,
+                          batch.column(PERIOD_START_COLUMN) if PERIOD_START_COLUMN in batch.headers else None,
+                          batch.column(LINE_ITEM_TYPE_COLUMN) if LINE_ITEM_TYPE_COLUMN in batch.headers else None)
+        # usage start dates are all in USAGE_TIME_FORMAT, they compare as strings
+        return map(operator.or_, map(window_start.__le__, usage_starts), kept)
+    return within_window
@@ -0,0 +1,226 @@
+import itertools
+import json
+import math
+
+
+def _dumps_values(values):
+    # type: (list[object]) -> 'Iterator[str]'
+    """ json.dumps() of every value, with C calls only for the usual columns of finite floats or ints """
+    types = set(map(type, values))
+    if types == {float} and all(map(math.isfinite, values)):
+        # json.dumps() writes floats with float.__repr__, and non finite ones as NaN or Infinity
+        return map(float.__repr__, values)
+    if types == {int}:
+        return map(int.__repr__, values)
+    return map(json.dumps, values)
+
+
+class _Column(object):
+    """
+    Per-report dictionary of the values seen in one column.
+
+    Batches keep track of how many of the column values were found in the
+    dictionary. Columns of mostly unique values (line item ids, resource ids,
+    costs) don't repeat enough to be worth their dictionary, it is dropped
+    and their values are encoded once per batch instead.
+    """
+    __slots__ = ('key', 'values', '_fragments', '_key_fragment', '_parse', '_max_values', '_lookups', '_misses')
+
+    # non empty cells looked up between two checks of the hit rate
+    HIT_RATE_LOOKUPS = 4096
+    MIN_HIT_RATE = 0.5
+
+    def __init__(self, key, parse, max_values):
+        # type: (str, 'Callable[[str], object]', int) -> None
+        self.key = key
+        self.values = {}
+        # the encoded fragment of every value in values, and nothing for empty cells
+        self._fragments = {'': ''}
+        self._key_fragment = ', {}: '.format(json.dumps(key))
+        self._parse = parse
+        self._max_values = max_values
+        self._lookups = 0
+        self._misses = 0
+
+    def set_parse(self, parse):
+        # type: ('Callable[[str], object]') -> None
+        """ Converts the next values with parse, the values seen so far are encoded again """
+        self._parse = parse
+        self.values = {}
+        self._fragments = {'': ''}
+
+    def _check_hit_rate(self, lookups, misses):
+        # type: (int, int) -> None
+        self._lookups += lookups
+        self._misses += misses
+        if self._lookups < self.HIT_RATE_LOOKUPS:
+            return
+        if self._misses > self._lookups * (1 - self.MIN_HIT_RATE):
+            # stop caching the column for the rest of the report
+            self._max_values = 0
+            self.values = {}
+            self._fragments = {'': ''}
+        self._lookups = self._misses = 0
+
+    def encode(self, value):
+        # type: (str) -> (object, str)
+        parsed = self._parse(value) if self._parse else value
+        entry = (parsed, self._key_fragment + json.dumps(parsed))
+        # high cardinality columns (line item ids, amounts) stop growing once the dictionary is full
+        if len(self.values) < self._max_values:
+            self.values[value] = entry
+            self._fragments[value] = entry[1]
+        return entry
+
+    def fragments(self, values):
+        # type: (tuple[str]) -> list[str]
+        """ The encoded fragment of every value of a column chunk, '' for empty cells """
+        # cells are looked up with map() over the dictionaries, without a python call per cell
+        fragments = list(map(self._fragments.get, values))
+        misses = fragments.count(None)
+        if self._max_values:
+            self._check_hit_rate(len(values) - fragments.count(''), misses)
+        if not misses:
+            return fragments
+
+        missing = list(set(values).difference(self._fragments))
+        if self._parse is None:
+            # same as json.dumps() for a str
+            parsed = missing
+            encoded = list(map(self._key_fragment.__add__, map(json.encoder.encode_basestring_ascii, missing)))
+        else:
+            parsed = list(map(self._parse, missing))
+            encoded = list(map(self._key_fragment.__add__, _dumps_values(parsed)))
+
+        # self.values may have been dropped by the hit rate check
+        room = self._max_values - len(self.values)
+        if room > 0:
+            self.values.update(zip(missing[:room], zip(parsed, encoded)))
+            self._fragments.update(zip(missing[:room], encoded))
+        chunk = dict(zip(missing, encoded))
+        return list(map(chunk.get, values, fragments))
+
+
+class ColumnBatch(object):
+    """
+    A chunk of report rows held as columns, to filter rows on whole columns
+    before encoding them.
+    """
+    __slots__ = ('headers', 'columns', '_index')
+
+    def __init__(self, headers, lines):
+        # type: (list[str], list[list[str]]) -> None
+        width = len(headers)
+        if set(map(len, lines)) - {width}:
+            # short rows are padded with empty cells, extra cells are dropped like zip() does per row
+            lines = [line[:width] + [''] * (width - len(line)) for line in lines]
+        self.headers = headers
+        self.columns = list(zip(*lines)) if lines else [() for _ in headers]
+        self._index = {header: idx for idx, header in enumerate(headers)}
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def column(self, header):
+        # type: (str) -> tuple[str]
+        """ The values of a column, empty when the report does not have it """
+        idx = self._index.get(header)
+        return self.columns[idx] if idx is not None else ('',) * len(self)
+
+    def compress(self, selectors):
+        # type: ('Iterable[bool]') -> None
+        """ Keeps the rows whose selector is true """
+        selectors = list(selectors)
+        self.columns = [tuple(itertools.compress(column, selectors)) for column in self.columns]
+
+
+class RowEncoder(object):
+    """
+    Dictionary-encodes the rows of one report.
+
+    Most CUR columns (product names, usage types, regions, accounts, tags) only
+    have a handful of distinct values, so every value is parsed and JSON encoded
+    once per report: later rows reuse the interned value and its encoded
+    '"key": value' fragment instead of allocating and escaping it again.
+    """
+    MAX_DISTINCT_VALUES = 4096
+    # rows encoded together by encode_batch()
+    BATCH_ROWS = 1024
+
+    def __init__(self, headers, event_time, fields_parser, max_distinct_values=None):
+        # type: (list[str], str, dict, int) -> None
+        self._event_time = event_time
+        self._uuid = "billing_report_{}".format(event_time)
+        # the encoded object without its closing brace
+        self._prefix = json.dumps({'@timestamp': self._event_time, 'uuid': self._uuid})[:-1]
+        max_values = max_distinct_values or self.MAX_DISTINCT_VALUES
+        self._headers = headers
+        self._columns = [_Column(header, fields_parser[header][0] if header in fields_parser else None, max_values)
+                         for header in headers]
+
+    def set_parser(self, header, parse):
+        # type: (str, 'Callable[[str], object]') -> None
+        """ Converts the values of the column header with parse from the next row on """
+        for column in self._columns:
+            if column.key == header:
+                column.set_parse(parse)
+
+    def encode(self, line):
+        # type: (list[str]) -> str
+        """ Same JSON as json.dumps(_parse_file(headers, line, event_time)) """
+        fragments = [self._prefix]
+        for column, tab in zip(self._columns, line):
+            if tab:
+                entry = column.values.get(tab)
+                if entry is None:
+                    entry = column.encode(tab)
+                fragments.append(entry[1])
+        fragments.append('}')
+        return ''.join(fragments)
+
+    def encode_batch(self, lines, row_filter=None):
+        # type: (list[list[str]], 'Callable[[ColumnBatch], Iterable[bool]]') -> list[str]
+        """
+        Same JSON as encode() for every line, encoded column by column.
+
+        row_filter gets the lines as a ColumnBatch and returns whether to keep
+        each row; only the rows kept are encoded.
+        """
+        batch = ColumnBatch(self._headers, lines)
+        if row_filter is not None:
+            batch.compress(row_filter(batch))
+        if not len(batch):
+            return []
+        fragments = [column.fragments(values) for column, values in zip(self._columns, batch.columns)]
+        return list(map(''.join, zip(itertools.repeat(self._prefix), *fragments, itertools.repeat('}'))))
+
+    def encode_rows(self, rows, row_filter=None, batch_rows=None):
+        # type: ('Iterable[list[str]]', 'Callable[[ColumnBatch], Iterable[bool]]', int) -> 'Iterator[str]'
+        """ encode_batch() over the rows, batch_rows rows at a time """
+        rows = iter(rows)
+        batch_rows = batch_rows or self.BATCH_ROWS
+        while True:
+            lines = list(itertools.islice(rows, batch_rows))
+            if not lines:
+                return
+            for json_log in self.encode_batch(lines, row_filter):
+                yield json_log
+
+    def parse(self, line):
+        # type: (list[str]) -> dict
+        """ Same row as _parse_file(headers, line, event_time), with repeated values shared between rows """
+        row = {
+            '@timestamp': self._event_time,
+            'uuid': self._uuid,
+        }
+        for column, tab in zip(self._columns, line):
+            if tab:
+                entry = column.values.get(tab)
+                if entry is None:
+                    entry = column.encode(tab)
+                row[column.key] = entry[0]
+        return row
+
+    def distinct_values(self):
+        # type: () -> dict
+        return {column.key: len(column.values) for column in self._columns}
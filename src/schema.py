@@ -0,0 +1,289 @@
+import hashlib
+import itertools
+import logging
+import math
+import operator
+
+# Set logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+TYPE_FLOAT = 'float'
+TYPE_STR = 'str'
+
+# numeric looking columns that must keep their exact text (leading zeros, free-form user values),
+# matched in any case against camelCase (bill_PayerAccountId) and snake_case (bill_payer_account_id) headers
+_TEXT_COLUMN_SUFFIXES = ('id', 'ids', 'arn')
+_TEXT_COLUMN_PREFIXES = ('resourcetags_', 'resource_tags_', 'costcategory_', 'cost_category_')
+
+
+def _parse_float(s):
+    try:
+        return float(s)
+    except ValueError:
+        return s
+
+
+def _parse_int(s):
+    try:
+        return int(s)
+    except ValueError:
+        return s
+
+
+_INFERRED_PARSERS = {
+    TYPE_FLOAT: (_parse_float, float),
+}
+
+
+def _is_text_column(header):
+    # type: (str) -> bool
+    lowered = header.lower()
+    if lowered.startswith(_TEXT_COLUMN_PREFIXES):
+        return True
+    for suffix in _TEXT_COLUMN_SUFFIXES:
+        if lowered.endswith(suffix):
+            # the suffix has to be a word of its own: AccountId, ReservationARN, account_id, not Prepaid
+            start = len(header) - len(suffix)
+            if header[start].isupper() or header[start - 1:start] in ('', '_', '/'):
+                return True
+    return False
+
+
+def _is_number(value):
+    # type: (str) -> bool
+    digits = value[1:] if value[:1] in '+-' else value
+    # a leading zero means an identifier, the number would drop it
+    if len(digits) > 1 and digits[0] == '0' and digits[1].isdigit():
+        return False
+    try:
+        return math.isfinite(float(value))
+    except ValueError:
+        return False
+
+
+def _infer_type(values):
+    # type: ('Iterable[str]') -> 'str|None'
+    """ None when there is no value to infer from """
+    inferred = None
+    for value in values:
+        if not value:
+            continue
+        # whole numbers are typed as float too: many columns only have fractions later in the
+        # month (normalization factors of small instances), and an integer mapping would truncate them
+        if not _is_number(value):
+            return TYPE_STR
+        inferred = TYPE_FLOAT
+    return inferred
+
+
+def header_signature(headers):
+    # type: (list[str]) -> str
+    return hashlib.sha1('\x1f'.join(headers).encode('utf-8')).hexdigest()
+
+
+class ReportSchema(object):
+    """
+    Column types of a report, inferred from its first rows.
+
+    Columns declared in get_fields_parser() keep their declared type, every
+    other column is typed as float or str from the sampled values. Columns
+    without a value in the sample stay unknown and are learned while the rest
+    of the report streams by: on_learned gets the converter of a learned
+    numeric column before the rows it was learned from are returned. Columns
+    that are empty in the whole report are typed as str. Inferred converters
+    fall back to the original text for values that do not parse, and record
+    the column in fallbacks.
+    """
+    SAMPLE_ROWS = 1000
+    # values of an unknown column collected after the sample before its type is learned
+    LEARNED_VALUES = 100
+    LEARN_CHUNK_ROWS = 1024
+
+    def __init__(self, headers, types):
+        # type: (list[str], dict) -> None
+        self.headers = headers
+        self.types = types
+        # inferred numeric columns with values that did not parse
+        self.fallbacks = set()
+        # called with the header and converter of every numeric column learned from the rows
+        self.on_learned = None
+
+    @property
+    def complete(self):
+        # type: () -> bool
+        return all(header in self.types for header in self.headers)
+
+    def unknown_columns(self):
+        # type: () -> list[int]
+        return [idx for idx, header in enumerate(self.headers) if header not in self.types]
+
+    @classmethod
+    def from_values(cls, headers, values, fields_parser, known_types=None):
+        # type: (list[str], 'Callable[[int], Iterable[str]]', dict, dict) -> ReportSchema
+        """ values(idx) returns the values seen in the column at idx """
+        types = dict(known_types or {})
+        for idx, header in enumerate(headers):
+            if header in types:
+                continue
+            if header in fields_parser:
+                types[header] = fields_parser[header][1].__name__
+            elif _is_text_column(header):
+                types[header] = TYPE_STR
+            else:
+                inferred = _infer_type(values(idx))
+                if inferred is not None:
+                    types[header] = inferred
+        return cls(headers, types)
+
+    @classmethod
+    def infer(cls, headers, sample, fields_parser, known_types=None):
+        # type: (list[str], list[list[str]], dict, dict) -> ReportSchema
+        return cls.from_values(headers, lambda idx: (row[idx] for row in sample if idx < len(row)),
+                               fields_parser, known_types)
+
+    def fields_parser(self, fields_parser):
+        # type: (dict) -> dict
+        """ fields_parser extended with a converter for every inferred numeric column """
+        parsers = {header: self._inferred_parser(header, column_type) for header, column_type in self.types.items()
+                   if column_type in _INFERRED_PARSERS}
+        parsers.update(fields_parser)
+        return parsers
+
+    def _inferred_parser(self, header, column_type):
+        # type: (str, str) -> tuple
+        parse, result_type = _INFERRED_PARSERS[column_type]
+
+        def parse_or_fallback(s):
+            value = parse(s)
+            if value is s:
+                self.fallbacks.add(header)
+            return value
+        return parse_or_fallback, result_type
+
+    def learn(self, header, column_type):
+        # type: (str, str) -> None
+        self.types[header] = column_type
+        if self.on_learned is not None and column_type in _INFERRED_PARSERS:
+            self.on_learned(header, self._inferred_parser(header, column_type)[0])
+
+    def to_json(self):
+        # type: () -> dict
+        return {'headers': list(self.headers), 'types': dict(self.types)}
+
+    @classmethod
+    def from_json(cls, content):
+        # type: (dict) -> ReportSchema
+        return cls(content['headers'], content['types'])
+
+
+def _schema_name(signature):
+    # type: (str) -> str
+    return "schema-{}.json".format(signature)
+
+
+def _put_schema(schema, signature, store):
+    # type: (ReportSchema, str, object) -> None
+    logger.info("Inferred the types of {0} columns out of {1}".format(len(schema.types), len(schema.headers)))
+    if store is not None:
+        store.put(_schema_name(signature), schema.to_json())
+
+
+def _save_schema(schema, previous, signature, store, cache):
+    # type: (ReportSchema, ReportSchema, str, object, dict) -> None
+    cache[signature] = schema
+    if previous is not None and previous.types == schema.types:
+        return
+    _put_schema(schema, signature, store)
+
+
+def _column_values(rows, idx):
+    # type: (list[list[str]], int) -> 'Iterator[str]'
+    """ The non empty values of the column at idx """
+    try:
+        return filter(None, list(map(operator.itemgetter(idx), rows)))
+    except IndexError:
+        return filter(None, [row[idx] for row in rows if idx < len(row)])
+
+
+def _learn_unknown_types(rows, schema, signature, store, whole_report):
+    # type: ('Iterator[list[str]]', ReportSchema, str, object, bool) -> 'Iterator[list[str]]'
+    """ Learns the unknown columns of schema in place, from the rows it yields """
+    pending = {idx: [] for idx in schema.unknown_columns()}
+    while True:
+        # the columns still unknown are looked at a chunk of rows at a time, and less of them as they are learned
+        chunk = list(itertools.islice(rows, ReportSchema.LEARN_CHUNK_ROWS))
+        if not chunk:
+            break
+        learned = False
+        for idx, values in list(pending.items()):
+            values.extend(itertools.islice(_column_values(chunk, idx), ReportSchema.LEARNED_VALUES - len(values)))
+            if len(values) >= ReportSchema.LEARNED_VALUES:
+                del pending[idx]
+                schema.learn(schema.headers[idx], _infer_type(values))
+                learned = True
+        # saved once for all the columns learned from the chunk
+        if learned:
+            _put_schema(schema, signature, store)
+        for row in chunk:
+            yield row
+
+    learned = False
+    for idx, values in pending.items():
+        column_type = _infer_type(values)
+        # columns empty in the whole report are resolved as text, so the next runs find a complete schema
+        if column_type is None and whole_report:
+            column_type = TYPE_STR
+        if column_type is not None:
+            schema.learn(schema.headers[idx], column_type)
+            learned = True
+    if learned:
+        _put_schema(schema, signature, store)
+
+
+def demote_fallbacks(schema, store, cache=None):
+    # type: (ReportSchema, object, dict) -> None
+    """ Types as str the inferred numeric columns that had values that did not parse, for the next runs """
+    demoted = [header for header in schema.fallbacks if schema.types.get(header) in _INFERRED_PARSERS]
+    if not demoted:
+        return
+    logger.info("Typing {0} columns as text, they have values that are not numbers: {1}".format(
+        len(demoted), ', '.join(sorted(demoted))))
+    for header in demoted:
+        schema.types[header] = TYPE_STR
+    signature = header_signature(schema.headers)
+    if cache is not None:
+        cache[signature] = schema
+    _put_schema(schema, signature, store)
+
+
+def load_schema(headers, rows, fields_parser, store, cache=None, whole_report=True):
+    # type: (list[str], 'Iterator[list[str]]', dict, object, dict, bool) -> (ReportSchema, 'Iterator[list[str]]')
+    """
+    Returns the schema of the report and its rows.
+
+    The schema is looked up by header signature in cache (process lifetime),
+    then in store. Inference only runs when neither has a complete schema,
+    and the rows it samples are put back in front of the returned rows.
+    The returned schema learns its unknown columns while the returned rows are read.
+    whole_report is False when rows don't start at the beginning of the report,
+    columns without values are then left unknown.
+    """
+    signature = header_signature(headers)
+    cache = {} if cache is None else cache
+    schema = cache.get(signature)
+    if schema is None and store is not None:
+        content = store.get(_schema_name(signature))
+        if content is not None and content.get('headers') == headers:
+            schema = ReportSchema.from_json(content)
+    if schema is not None and schema.complete:
+        cache[signature] = schema
+        return schema, rows
+
+    sample = list(itertools.islice(rows, ReportSchema.SAMPLE_ROWS))
+    inferred = ReportSchema.infer(headers, sample, fields_parser, schema.types if schema else None)
+    _save_schema(inferred, schema, signature, store, cache)
+    rows = itertools.chain(sample, rows)
+    if not inferred.complete:
+        rows = _learn_unknown_types(rows, inferred, signature, store, whole_report)
+    return inferred, rows
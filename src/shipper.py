@@ -1,6 +1,8 @@
 import json
 import logging
+import queue
 import sys
+import threading
 import time
 import urllib.request
 import urllib.parse
@@ -30,53 +32,260 @@ class UnknownURL(Exception):
     pass
 
 
+class AdaptiveController(object):
+    """
+    Tunes the bulk size and the number of bulks in flight from the listener responses (AIMD).
+
+    Fast successful responses grow the bulk size by a fixed step, and the
+    concurrency by one after a full round of fast responses. Throttling
+    (429) and server errors (5xx) halve both, and slow responses halve the
+    concurrency. Only requests sent after the last decrease can decrease
+    again, so one congested moment is not punished once per bulk in flight.
+    """
+    MIN_BULK_SIZE_IN_BYTES = 256 * 1024
+    BULK_SIZE_STEP_IN_BYTES = 128 * 1024
+    TARGET_LATENCY_IN_SECONDS = 2.0
+    DECREASE_FACTOR = 0.5
+
+    def __init__(self, max_bulk_size_in_bytes, max_concurrency, min_bulk_size_in_bytes=None,
+                 initial_bulk_size_in_bytes=None, target_latency_in_seconds=None):
+        # type: (int, int, int, int, float) -> None
+        self.max_bulk_size = max_bulk_size_in_bytes
+        self.min_bulk_size = min(min_bulk_size_in_bytes or self.MIN_BULK_SIZE_IN_BYTES, max_bulk_size_in_bytes)
+        self.max_concurrency = max(max_concurrency, 1)
+        self.target_latency = target_latency_in_seconds or self.TARGET_LATENCY_IN_SECONDS
+        initial_bulk_size = initial_bulk_size_in_bytes or LogzioShipper.MAX_BULK_SIZE_IN_BYTES
+        self.bulk_size = min(max(initial_bulk_size, self.min_bulk_size), self.max_bulk_size)
+        self.concurrency = 1
+
+        self._lock = threading.Lock()
+        self._last_decrease = time.monotonic()
+        self._fast_responses = 0
+        self._stats = {
+            'responses': 0,
+            'throttled': 0,
+            'server_errors': 0,
+            'slow_responses': 0,
+            'total_latency': 0.0,
+            'min_bulk_size_reached': self.bulk_size,
+            'max_bulk_size_reached': self.bulk_size,
+            'max_concurrency_reached': self.concurrency,
+        }
+
+    def observe(self, started, latency, status_code):
+        # type: (float, float, int) -> None
+        """ started is the time.monotonic() the request was sent at """
+        with self._lock:
+            self._stats['responses'] += 1
+            self._stats['total_latency'] += latency
+            if status_code == 429 or status_code >= 500:
+                self._stats['throttled' if status_code == 429 else 'server_errors'] += 1
+                self._decrease(started, bulk_size=True)
+            elif latency > self.target_latency:
+                self._stats['slow_responses'] += 1
+                self._decrease(started, bulk_size=False)
+            elif status_code < 300:
+                self._increase()
+
+    def _increase(self):
+        self.bulk_size = min(self.bulk_size + self.BULK_SIZE_STEP_IN_BYTES, self.max_bulk_size)
+        self._fast_responses += 1
+        if self._fast_responses >= self.concurrency:
+            self._fast_responses = 0
+            self.concurrency = min(self.concurrency + 1, self.max_concurrency)
+        self._stats['max_bulk_size_reached'] = max(self._stats['max_bulk_size_reached'], self.bulk_size)
+        self._stats['max_concurrency_reached'] = max(self._stats['max_concurrency_reached'], self.concurrency)
+
+    def _decrease(self, started, bulk_size):
+        # responses to requests that were already in flight at the last decrease are ignored
+        if started < self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+        self._fast_responses = 0
+        self.concurrency = max(int(self.concurrency * self.DECREASE_FACTOR), 1)
+        if bulk_size:
+            self.bulk_size = max(int(self.bulk_size * self.DECREASE_FACTOR), self.min_bulk_size)
+            self._stats['min_bulk_size_reached'] = min(self._stats['min_bulk_size_reached'], self.bulk_size)
+
+    def summary(self):
+        # type: () -> dict
+        with self._lock:
+            summary = dict(self._stats)
+            summary['bulk_size'] = self.bulk_size
+            summary['concurrency'] = self.concurrency
+            summary['mean_latency'] = summary.pop('total_latency') / max(summary['responses'], 1)
+        return summary
+
+
+class _BulkSender(object):
+    """
+    Sends bulks from background threads while the next bulk is being filled.
+
+    Bulk buffers come from a fixed pool, so the number of bulks held in memory is
+    bounded: when every buffer is waiting to be sent, submit() blocks until a
+    sender hands one back, which slows the parser down to the sending rate.
+    With a controller, up to controller.concurrency bulks are sent at once.
+    """
+
+    def __init__(self, send, pending_bulks, controller=None):
+        # type: ('Callable[[list[str]], None]', int, AdaptiveController) -> None
+        self._send = send
+        self._controller = controller
+        self._error = None
+        self._in_flight = 0
+        self._in_flight_changed = threading.Condition()
+        self._pending = queue.Queue()
+        self._free = queue.Queue()
+        for _ in range(pending_bulks):
+            self._free.put([])
+        threads = controller.max_concurrency if controller else 1
+        self._threads = [threading.Thread(target=self._run, name='logzio-bulk-sender-{}'.format(i), daemon=True)
+                         for i in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def _concurrency(self):
+        # type: () -> int
+        return self._controller.concurrency if self._controller else 1
+
+    def _run(self):
+        while True:
+            logs = self._pending.get()
+            if logs is None:
+                self._pending.task_done()
+                return
+            with self._in_flight_changed:
+                self._in_flight_changed.wait_for(lambda: self._in_flight < self._concurrency())
+                self._in_flight += 1
+            try:
+                # after a failure keep draining, so the producer is never blocked on a free buffer
+                if self._error is None:
+                    self._send(logs)
+            except Exception as e:
+                self._error = e
+            finally:
+                with self._in_flight_changed:
+                    self._in_flight -= 1
+                    self._in_flight_changed.notify_all()
+                logs.clear()
+                self._free.put(logs)
+                self._pending.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, logs):
+        # type: (list[str]) -> list[str]
+        """ Queues a full bulk for sending and returns an empty buffer for the next one """
+        self._raise_error()
+        self._pending.put(logs)
+        buff = self._free.get()
+        self._raise_error()
+        return buff
+
+    def join(self):
+        # type: () -> None
+        self._pending.join()
+        self._raise_error()
+
+    def close(self):
+        # type: () -> None
+        for _ in self._threads:
+            self._pending.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
 class LogzioShipper(object):
     MAX_BULK_SIZE_IN_BYTES = 1 * 1024 * 1024
+    SLEEP_BETWEEN_RETRIES_IN_SECONDS = 2
 
-    retries_counter = 0
-
-    def __init__(self, logzio_url):
+    def __init__(self, logzio_url, max_bulk_size_in_bytes=None, pending_bulks=0, controller=None):
+        # type: (str, int, int, AdaptiveController) -> None
         self._size = 0
         self._logs = []
         self._logzio_url = logzio_url
+        self._max_bulk_size = max_bulk_size_in_bytes or self.MAX_BULK_SIZE_IN_BYTES
+        # the controller picks the bulk size and concurrency, within max_bulk_size and pending_bulks
+        self._controller = controller
+        # without pending bulks, sending is done synchronously by add() and flush()
+        self._sender = _BulkSender(self._send_to_logzio, pending_bulks, controller) if pending_bulks else None
+        self._stats_lock = threading.Lock()
+        self._stats = {'bulks_sent': 0, 'logs_sent': 0, 'bytes_sent': 0, 'failed_requests': 0}
 
     def add(self, log):
         # type: (dict) -> None
-        json_log = json.dumps(log)
+        self.add_json(json.dumps(log))
+
+    def add_json(self, json_log):
+        # type: (str) -> None
+        """ Adds a log that is already encoded as a JSON object """
         self._logs.append(json_log)
         self._size += sys.getsizeof(json_log)
         self._try_to_send()
 
-    def _reset(self):
+    def _reset(self, logs):
         self._size = 0
-        self._logs = []
+        self._logs = logs
+
+    def _send_bulk(self):
+        if self._sender is None:
+            self._send_to_logzio(self._logs)
+            self._logs.clear()
+            self._reset(self._logs)
+        else:
+            self._reset(self._sender.submit(self._logs))
+
+    def _bulk_size(self):
+        # type: () -> int
+        if self._controller is None:
+            return self._max_bulk_size
+        return min(self._controller.bulk_size, self._max_bulk_size)
 
     def _try_to_send(self):
-        if self._size > self.MAX_BULK_SIZE_IN_BYTES:
-            self._send_to_logzio()
-            self._reset()
+        if self._size > self._bulk_size():
+            self._send_bulk()
 
     def flush(self):
         if self._size:
-            self._send_to_logzio()
-            self._reset()
+            self._send_bulk()
+        if self._sender is not None:
+            self._sender.join()
+
+    def close(self):
+        # type: () -> None
+        """ Stops the background sender, pending bulks are sent first """
+        if self._sender is not None:
+            self._sender.close()
+            self._sender = None
+
+    def summary(self):
+        # type: () -> dict
+        """ What was shipped, and the bulk size and concurrency the controller settled on """
+        with self._stats_lock:
+            summary = dict(self._stats)
+        if self._controller is not None:
+            summary.update(self._controller.summary())
+        else:
+            summary.update(bulk_size=self._max_bulk_size, concurrency=1 if self._sender else 0)
+        return summary
 
     @staticmethod
     def retry(func):
         def retry_func():
             max_retries = 4
-            sleep_between_retries = 2
+            sleep_between_retries = LogzioShipper.SLEEP_BETWEEN_RETRIES_IN_SECONDS
 
             for retries in range(max_retries):
-                LogzioShipper.retries_counter = retries
-
                 if retries:
                     sleep_between_retries *= 2
                     logger.info("Failure in sending logs - Trying again in {} seconds"
                                 .format(sleep_between_retries))
                     time.sleep(sleep_between_retries)
                 try:
-                    res = func()
+                    # the counter is local, bulks are retried by several sender threads at once
+                    res = func(retries)
                 except urllib.error.HTTPError as e:
                     status_code = e.getcode()
                     if status_code == 400:
@@ -96,20 +305,29 @@ class LogzioShipper(object):
 
         return retry_func
 
-    def _send_to_logzio(self):
+    def _send_to_logzio(self, logs):
+        # type: (list[str]) -> None
+        compressed_data = gzip.compress(str.encode('\n'.join(logs)))
+
         @LogzioShipper.retry
-        def do_request():
+        def do_request(retries):
             headers = {"Content-type": "application/json",
                        "Content-Encoding": "gzip",
-                       "Logzio-Shipper": "aws-cost-and-usage/v{0}/{1}/0.".format(VERSION,
-                                                                                 LogzioShipper.retries_counter)}
-            compressed_data = gzip.compress(str.encode('\n'.join(self._logs)))
+                       "Logzio-Shipper": "aws-cost-and-usage/v{0}/{1}/0.".format(VERSION, retries)}
             request = urllib.request.Request(self._logzio_url, data=compressed_data, headers=headers)
-            return urllib.request.urlopen(request)
+            started = time.monotonic()
+            try:
+                res = urllib.request.urlopen(request)
+            except urllib.error.HTTPError as e:
+                self._observe(started, e.getcode())
+                raise
+            self._observe(started, res.getcode())
+            return res
 
         try:
             do_request()
-            logger.info("Successfully sent bulk of {} logs to Logz.io!".format(len(self._logs)))
+            logger.info("Successfully sent bulk of {} logs to Logz.io!".format(len(logs)))
+            self._count_sent(logs, len(compressed_data))
         except MaxRetriesException:
             logger.error('Retry limit reached. Failed to send log entry.')
             raise MaxRetriesException()
@@ -126,3 +344,19 @@ class LogzioShipper(object):
         except urllib.error.HTTPError as e:
             logger.error("Unexpected error while trying to send logs: {}".format(e))
             raise
+
+    def _count_sent(self, logs, bytes_sent):
+        # type: (list[str], int) -> None
+        with self._stats_lock:
+            self._stats['bulks_sent'] += 1
+            self._stats['logs_sent'] += len(logs)
+            self._stats['bytes_sent'] += bytes_sent
+
+    def _observe(self, started, status_code):
+        # type: (float, int) -> None
+        latency = time.monotonic() - started
+        if status_code >= 300:
+            with self._stats_lock:
+                self._stats['failed_requests'] += 1
+        if self._controller is not None:
+            self._controller.observe(started, latency, status_code)
@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+
+from botocore.exceptions import ClientError
+
+# Set logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class S3Store(object):
+    """ JSON documents kept next to the reports, under a prefix of the reports bucket """
+
+    def __init__(self, s3client, bucket, prefix):
+        # type: ('boto3.client', str, str) -> None
+        self._s3client = s3client
+        self._bucket = bucket
+        self._prefix = prefix.rstrip('/')
+
+    def _key(self, name):
+        # type: (str) -> str
+        return "{0}/{1}".format(self._prefix, name)
+
+    def get(self, name):
+        # type: (str) -> 'dict|None'
+        try:
+            obj = self._s3client.get_object(Bucket=self._bucket, Key=self._key(name))
+            return json.loads(obj['Body'].read())
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'NoSuchKey':
+                logger.warning("Could not read {0} from the cache: {1}".format(self._key(name), e))
+        except ValueError as e:
+            logger.warning("Ignoring invalid {0} in the cache: {1}".format(self._key(name), e))
+        return None
+
+    def put(self, name, content):
+        # type: (str, dict) -> None
+        # the cache is an optimization, the function still works without write access to the bucket
+        try:
+            self._s3client.put_object(Bucket=self._bucket, Key=self._key(name), Body=json.dumps(content))
+        except ClientError as e:
+            logger.warning("Could not write {0} to the cache: {1}".format(self._key(name), e))
+
+
+class FileStore(object):
+    """ JSON documents kept in a local directory """
+
+    def __init__(self, directory):
+        # type: (str) -> None
+        self._directory = directory
+
+    def get(self, name):
+        # type: (str) -> 'dict|None'
+        try:
+            with open(os.path.join(self._directory, name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, name, content):
+        # type: (str, dict) -> None
+        os.makedirs(self._directory, exist_ok=True)
+        with open(os.path.join(self._directory, name), 'w') as f:
+            json.dump(content, f)
+
+
+class MemoryStore(object):
+    """ JSON documents kept for the lifetime of the process """
+
+    def __init__(self):
+        self._documents = {}
+
+    def get(self, name):
+        # type: (str) -> 'dict|None'
+        return self._documents.get(name)
+
+    def put(self, name, content):
+        # type: (str, dict) -> None
+        self._documents[name] = content
@@ -3,18 +3,32 @@ import csv
 import datetime
 import gzip
 import httpretty
+import itertools
 import json
 import logging
 import os
 import src.lambda_function as worker
+import src.replay as replay
 import src.shipper as shipper
 import unittest
+import tempfile
+import threading
+import time
+import unittest.mock
 import yaml
 
 from . import utils
+from benchmarks import cur_generator, run as benchmark
+from benchmarks.stand_ins import ListenerStandIn, LocalS3Client
 from csv import DictReader
 from logging.config import fileConfig
-from src.shipper import BadLogsException, UnknownURL, UnauthorizedAccessException, MaxRetriesException
+from src.memory_budget import MemoryBudget
+from src.report_index import ReportIndex, load_report_index, usage_window_filter
+from src.row_encoder import ColumnBatch, RowEncoder
+from src.schema import ReportSchema, load_schema
+from src.store import FileStore, MemoryStore, S3Store
+from src.shipper import AdaptiveController, BadLogsException, UnknownURL, UnauthorizedAccessException, \
+    MaxRetriesException
 from zlib import error as zlib_error
 
 # create logger assuming running from ./run script
@@ -316,5 +330,569 @@ class TestLambdaFunction(unittest.TestCase):
                 ship.flush()
 
 
+class TestBenchmarkPipeline(unittest.TestCase):
+    """ Runs the lambda function over synthetic reports with local S3 and listener stand-ins """
+
+    def test_synthetic_reports_are_fully_shipped(self):
+        rows = 500
+        with tempfile.TemporaryDirectory() as work_dir:
+            files = []
+            for part, granularity in enumerate([cur_generator.GRANULARITY_HOURLY,
+                                                cur_generator.GRANULARITY_MONTHLY]):
+                path = os.path.join(work_dir, "report-{}.csv.gz".format(part))
+                meta = cur_generator.write_report(path, rows, benchmark.EVENT_TIME, granularity=granularity,
+                                                  resource_ids=bool(part), tag_columns=5, seed=part)
+                self.assertEqual(meta['columns'], len(cur_generator.report_headers(bool(part), 5)))
+                files.append(path)
+
+            result = benchmark.run_pipeline(files)
+
+        self.assertEqual(result['logs_shipped'], rows * len(files))
+        self.assertGreater(result['bytes_shipped'], 0)
+        self.assertGreater(result['peak_rss_kb'], 0)
+
+
+class TestMemoryBoundedPipeline(unittest.TestCase):
+    """ Unit testing the memory budget and the bounded bulk sender """
+
+    def test_budget_from_lambda_memory(self):
+        with unittest.mock.patch.dict(os.environ, {'AWS_LAMBDA_FUNCTION_MEMORY_SIZE': '256'}):
+            os.environ.pop('MEMORY_BUDGET_MB', None)
+            small = MemoryBudget.from_environment()
+        with unittest.mock.patch.dict(os.environ, {'AWS_LAMBDA_FUNCTION_MEMORY_SIZE': '256',
+                                                   'MEMORY_BUDGET_MB': '1024'}):
+            large = MemoryBudget.from_environment()
+
+        self.assertEqual(small.budget_in_bytes, 128 * 1024 * 1024)
+        self.assertEqual(large.budget_in_bytes, 1024 * 1024 * 1024)
+        for budget in (small, large):
+            in_flight = (budget.pending_bulks + 1) * budget.bulk_size_in_bytes * MemoryBudget.BULK_MEMORY_FACTOR
+            batch = budget.batch_rows(100) * 100 * MemoryBudget.BATCH_BYTES_PER_CELL
+            self.assertLessEqual(in_flight + 2 * budget.decompressed_chunk_size + batch, budget.budget_in_bytes)
+        self.assertLessEqual(small.pending_bulks, large.pending_bulks)
+        # wider reports are encoded in smaller batches
+        self.assertLess(small.batch_rows(200), small.batch_rows(50))
+
+    def test_sender_applies_backpressure(self):
+        release = threading.Event()
+        sent = []
+
+        def send(logs):
+            release.wait()
+            sent.append(list(logs))
+
+        sender = shipper._BulkSender(send, pending_bulks=2)
+        # the first bulk is taken by the sender thread, the second one waits in the queue
+        buff = sender.submit(['1'])
+        buff.append('2')
+        buff = sender.submit(buff)
+        buff.append('3')
+        blocked = threading.Thread(target=sender.submit, args=(buff,))
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive(), "submit should block while every buffer is in flight")
+
+        release.set()
+        blocked.join(5)
+        self.assertFalse(blocked.is_alive())
+        sender.join()
+        sender.close()
+        self.assertEqual(sent, [['1'], ['2'], ['3']])
+
+    @httpretty.activate
+    def test_sender_raises_send_errors(self):
+        logzio_url = "https://listener.logz.io:8071/?token=123456789s&type=billing"
+        httpretty.register_uri(httpretty.POST, logzio_url, status=400)
+        ship = shipper.LogzioShipper(logzio_url, max_bulk_size_in_bytes=1024, pending_bulks=2)
+        with self.assertRaises(BadLogsException):
+            for i in range(1000):
+                ship.add({'line': i})
+            ship.flush()
+        ship.close()
+
+    def test_pending_bulks_are_all_shipped(self):
+        with ListenerStandIn() as listener:
+            ship = shipper.LogzioShipper(listener.url, max_bulk_size_in_bytes=4096, pending_bulks=2)
+            for i in range(5000):
+                ship.add({'line': i})
+            ship.flush()
+            ship.close()
+
+        self.assertGreater(listener.requests, 10)
+        self.assertEqual(listener.logs_received, 5000)
+
+
+class TestRowEncoder(unittest.TestCase):
+    """ Unit testing the dictionary encoding of report rows """
+
+    def setUp(self):
+        with gzip.open(SAMPLE_CSV_GZIP_1) as f:
+            r = csv.reader(f.read().decode('utf-8').splitlines())
+            self.headers = [header.replace('/', '_') for header in next(r)]
+            self.rows = list(r)
+        self.event_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    def test_same_json_as_parse_file(self):
+        encoder = RowEncoder(self.headers, self.event_time, worker.get_fields_parser())
+        for row in self.rows:
+            self.assertEqual(encoder.encode(row), json.dumps(worker._parse_file(self.headers, row, self.event_time)))
+
+    def test_repeated_values_are_shared(self):
+        encoder = RowEncoder(self.headers, self.event_time, worker.get_fields_parser(), max_distinct_values=100)
+        first, second = [encoder.parse(list(row)) for row in self.rows[:2]]
+        self.assertEqual(first, worker._parse_file(self.headers, self.rows[0], self.event_time))
+        self.assertIs(first['product_ProductName'], second['product_ProductName'])
+
+        for row in self.rows:
+            encoder.parse(row)
+        distinct_values = encoder.distinct_values()
+        self.assertEqual(distinct_values['product_region'], 2)
+        # the line item ids are unique, their dictionary stops growing
+        self.assertEqual(distinct_values['identity_LineItemId'], 100)
+
+    def test_batch_same_json_as_encode(self):
+        fields_parser = ReportSchema.infer(self.headers, self.rows, worker.get_fields_parser()) \
+            .fields_parser(worker.get_fields_parser())
+        expected = [RowEncoder(self.headers, self.event_time, fields_parser).encode(row) for row in self.rows]
+        encoder = RowEncoder(self.headers, self.event_time, fields_parser, max_distinct_values=10)
+        self.assertEqual(list(encoder.encode_rows(self.rows, batch_rows=7)), expected)
+
+        # short and long rows are encoded like encode() does
+        rows = [self.rows[0][:5], self.rows[1] + ['extra']]
+        self.assertEqual(encoder.encode_batch(rows), [encoder.encode(row) for row in rows])
+
+    def test_high_cardinality_columns_are_not_cached(self):
+        headers = ['identity_LineItemId', 'lineItem_UnblendedCost', 'product_region']
+        rows = [['id-{}'.format(i), '{:.10f}'.format(i / 7), 'us-east-{}'.format(i % 3)] for i in range(20000)]
+        encoder = RowEncoder(headers, self.event_time, worker.get_fields_parser())
+        self.assertEqual(list(encoder.encode_rows(rows)), [encoder.encode(row) for row in rows])
+
+        distinct_values = encoder.distinct_values()
+        # the unique columns dropped their dictionaries after the first hit rate check
+        self.assertEqual(distinct_values['identity_LineItemId'], 0)
+        self.assertEqual(distinct_values['lineItem_UnblendedCost'], 0)
+        self.assertEqual(distinct_values['product_region'], 3)
+
+    def test_batch_filter_on_columns(self):
+        encoder = RowEncoder(self.headers, self.event_time, worker.get_fields_parser())
+        region = self.rows[0][self.headers.index('product_region')]
+
+        def same_region(batch):
+            return [value == region for value in batch.column('product_region')]
+
+        expected = [encoder.encode(row) for row in self.rows if row[self.headers.index('product_region')] == region]
+        self.assertTrue(0 < len(expected) < len(self.rows))
+        self.assertEqual(list(encoder.encode_rows(self.rows, same_region, batch_rows=5)), expected)
+        self.assertEqual(encoder.encode_batch(self.rows, lambda batch: [False] * len(batch)), [])
+
+
+class TestAdaptiveController(unittest.TestCase):
+    """ Unit testing the bulk size and concurrency adaptation """
+
+    def test_additive_increase_within_bounds(self):
+        controller = AdaptiveController(2 * 1024 * 1024, 4, initial_bulk_size_in_bytes=1024 * 1024)
+        for _ in range(100):
+            controller.observe(time.monotonic(), 0.01, 200)
+
+        self.assertEqual(controller.bulk_size, 2 * 1024 * 1024)
+        self.assertEqual(controller.concurrency, 4)
+
+    def test_multiplicative_decrease(self):
+        controller = AdaptiveController(4 * 1024 * 1024, 8, min_bulk_size_in_bytes=512 * 1024)
+        for _ in range(100):
+            controller.observe(time.monotonic(), 0.01, 200)
+        started = time.monotonic()
+
+        controller.observe(started, 0.01, 429)
+        self.assertEqual((controller.bulk_size, controller.concurrency), (2 * 1024 * 1024, 4))
+        # requests that were in flight before the decrease don't decrease again
+        controller.observe(started, 0.01, 503)
+        self.assertEqual((controller.bulk_size, controller.concurrency), (2 * 1024 * 1024, 4))
+
+        # slow responses only reduce the concurrency
+        controller.observe(time.monotonic(), controller.target_latency * 2, 200)
+        self.assertEqual((controller.bulk_size, controller.concurrency), (2 * 1024 * 1024, 2))
+
+        for _ in range(3):
+            controller.observe(time.monotonic(), 0.01, 500)
+        self.assertEqual((controller.bulk_size, controller.concurrency), (512 * 1024, 1))
+
+        summary = controller.summary()
+        self.assertEqual((summary['throttled'], summary['server_errors'], summary['slow_responses']), (1, 4, 1))
+        self.assertEqual(summary['max_concurrency_reached'], 8)
+
+    def _ship(self, listener, logs):
+        controller = AdaptiveController(64 * 1024, 4, min_bulk_size_in_bytes=8 * 1024,
+                                        initial_bulk_size_in_bytes=16 * 1024, target_latency_in_seconds=1)
+        ship = shipper.LogzioShipper(listener.url, 64 * 1024, 4, controller)
+        with unittest.mock.patch.object(shipper.LogzioShipper, 'SLEEP_BETWEEN_RETRIES_IN_SECONDS', 0.01):
+            for i in range(logs):
+                ship.add({'line': i, 'padding': 'x' * 100})
+            ship.flush()
+            ship.close()
+        return ship.summary()
+
+    def test_concurrency_against_slow_listener(self):
+        with ListenerStandIn(latency=0.05) as listener:
+            summary = self._ship(listener, 5000)
+
+        self.assertEqual(listener.logs_received, 5000)
+        self.assertEqual(summary['logs_sent'], 5000)
+        self.assertGreater(listener.max_in_flight, 1)
+        self.assertLessEqual(listener.max_in_flight, 4)
+        self.assertEqual(summary['max_concurrency_reached'], 4)
+        self.assertEqual(summary['max_bulk_size_reached'], 64 * 1024)
+
+    def test_backs_off_when_throttled(self):
+        for status in (429, 503):
+            with ListenerStandIn(latency=0.01, fail_every=3, fail_status=status) as listener:
+                summary = self._ship(listener, 5000)
+
+            self.assertEqual(listener.logs_received, 5000)
+            self.assertEqual(summary['failed_requests'], listener.failed_requests)
+            self.assertGreater(summary['throttled' if status == 429 else 'server_errors'], 0)
+            self.assertLess(summary['min_bulk_size_reached'], 64 * 1024)
+            self.assertGreaterEqual(summary['min_bulk_size_reached'], 8 * 1024)
+            self.assertLessEqual(summary['concurrency'], 4)
+
+
+class TestReplay(unittest.TestCase):
+    """ Unit testing the local replay of report files """
+
+    def test_replay_manifest_directory_to_files(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            report_dir = os.path.join(work_dir, '20180201-20180301')
+            os.makedirs(os.path.join(report_dir, 'assembly'))
+            report_keys = []
+            for idx, report in enumerate([SAMPLE_CSV_GZIP_1, SAMPLE_CSV_GZIP_2]):
+                report_keys.append("prefix/report/20180201-20180301/assembly/report-{}.csv.gz".format(idx + 1))
+                with open(report, 'rb') as src, open(os.path.join(report_dir, 'assembly', os.path.basename(
+                        report_keys[-1])), 'wb') as dst:
+                    dst.write(src.read())
+            with open(os.path.join(report_dir, 'report-Manifest.json'), 'w') as f:
+                json.dump({'reportKeys': report_keys}, f)
+
+            output_dir = os.path.join(work_dir, 'bulks')
+            replay.main(['--output', output_dir, '--workers', '2', report_dir])
+
+            readers, shipped = [], 0
+            for report in [SAMPLE_CSV_GZIP_1, SAMPLE_CSV_GZIP_2]:
+                with gzip.open(report) as f:
+                    readers.append(DictReader(f.read().decode('utf-8').splitlines(True)))
+            for name in os.listdir(output_dir):
+                with gzip.open(os.path.join(output_dir, name)) as f:
+                    shipped += len(f.read().splitlines())
+
+        self.assertEqual(shipped, sum(sum(1 for _ in reader) for reader in readers))
+
+    def test_replay_zip_to_null(self):
+        summary = replay.replay_report((0, SAMPLE_CSV_ZIP_1, replay.argparse.Namespace(
+            output=os.devnull, workers=1, profile=None, cache_dir=None, event_time='2018-03-01T00:00:00Z')))
+        with gzip.open(SAMPLE_CSV_GZIP_1) as f:
+            rows = len(f.read().decode('utf-8').splitlines()) - 1
+        self.assertEqual(summary['logs_sent'], rows)
+
+    def test_replay_parquet_with_csv_headers(self):
+        import pyarrow
+        import pyarrow.parquet
+
+        table = pyarrow.table({
+            'identity_line_item_id': ['a1', 'a2'],
+            'bill_payer_account_id': ['486140753397', '486140753397'],
+            'line_item_usage_start_date': [datetime.datetime(2018, 2, 1), datetime.datetime(2018, 2, 1, 1)],
+            'line_item_unblended_cost': [0.5, 2.0],
+            'product_product_name': ['AWS Lambda', None],
+            'product_instance_type': ['m5.large', 'm5.large'],
+            'resource_tags_user_cost_center': ['1234', '1235'],
+        })
+        with tempfile.TemporaryDirectory() as work_dir:
+            path = os.path.join(work_dir, 'report-1.parquet')
+            pyarrow.parquet.write_table(table, path)
+            output_dir = os.path.join(work_dir, 'bulks')
+            replay.main(['--output', output_dir, '--event-time', '2018-03-01T00:00:00Z', path])
+            logs = []
+            for name in os.listdir(output_dir):
+                with gzip.open(os.path.join(output_dir, name)) as f:
+                    logs.extend(json.loads(line) for line in f.read().splitlines())
+
+        # the same fields as the lambda function ships for the CSV report
+        self.assertEqual(logs[0], {
+            '@timestamp': '2018-03-01T00:00:00Z',
+            'uuid': 'billing_report_2018-03-01T00:00:00Z',
+            'identity_LineItemId': 'a1',
+            'bill_PayerAccountId': '486140753397',
+            'lineItem_UsageStartDate': '2018-02-01T00:00:00Z',
+            'lineItem_UnblendedCost': 0.5,
+            'product_ProductName': 'AWS Lambda',
+            'product_instanceType': 'm5.large',
+            'resourceTags_user_cost_center': '1234',
+        })
+        self.assertNotIn('product_ProductName', logs[1])
+
+
+class TestReportSchema(unittest.TestCase):
+    """ Unit testing the inference and caching of column types """
+
+    def setUp(self):
+        with gzip.open(SAMPLE_CSV_GZIP_1) as f:
+            r = csv.reader(f.read().decode('utf-8').splitlines())
+            self.headers = [header.replace('/', '_') for header in next(r)]
+            self.rows = list(r)
+
+    def test_infer_types(self):
+        fields_parser = worker.get_fields_parser()
+        cache = {}
+        schema, rows = load_schema(self.headers, iter(self.rows), fields_parser, None, cache)
+
+        # the normalization columns are empty in the sampled rows, and learned from the next ones
+        self.assertNotIn('lineItem_NormalizationFactor', schema.types)
+        self.assertEqual(list(rows), self.rows)
+        self.assertIs(list(cache.values())[0], schema)
+        self.assertEqual(schema.types['lineItem_NormalizationFactor'], 'float')
+        self.assertEqual(schema.types['lineItem_NormalizedUsageAmount'], 'float')
+        self.assertEqual(schema.types['product_vcpu'], 'int')
+        self.assertEqual(schema.types['bill_PayerAccountId'], 'str')
+        self.assertEqual(schema.types['product_sku'], 'str')
+
+        row = dict(zip(self.headers, next(row for row in self.rows if row[self.headers.index('product_vcpu')])))
+        encoded = json.loads(RowEncoder(self.headers, 'now', schema.fields_parser(fields_parser)).encode(
+            [row[header] for header in self.headers]))
+        self.assertEqual(encoded['lineItem_NormalizationFactor'], 32.0)
+        self.assertEqual(encoded['product_vcpu'], 16)
+        self.assertEqual(encoded['lineItem_UsageAccountId'], '486140753397')
+
+    def test_safe_fallback(self):
+        headers = ['amount', 'code', 'resourceTags_user_cost_center']
+        schema = ReportSchema.infer(headers, [['1.5', '0042', '1234'], ['2', '0043', '1235']], {})
+        self.assertEqual(schema.types, {'amount': 'float', 'code': 'str', 'resourceTags_user_cost_center': 'str'})
+
+        encoder = RowEncoder(headers, 'now', schema.fields_parser({}))
+        self.assertEqual(json.loads(encoder.encode(['n/a', '0042', '1234'])),
+                         {'@timestamp': 'now', 'uuid': 'billing_report_now', 'amount': 'n/a', 'code': '0042',
+                          'resourceTags_user_cost_center': '1234'})
+
+    def test_snake_case_text_columns(self):
+        headers = ['bill_payer_account_id', 'reservation_reservation_arn', 'resource_tags_user_team',
+                   'cost_category_team', 'line_item_unblended_cost', 'line_item_prepaid']
+        schema = ReportSchema.infer(headers, [['486140753397', '1', '1234', '42', '1.5', '3']], {})
+        self.assertEqual(schema.types, {'bill_payer_account_id': 'str', 'reservation_reservation_arn': 'str',
+                                        'resource_tags_user_team': 'str', 'cost_category_team': 'str',
+                                        'line_item_unblended_cost': 'float', 'line_item_prepaid': 'float'})
+
+    def test_learned_types_saved_once_per_chunk(self):
+        store = MemoryStore()
+        with unittest.mock.patch.object(store, 'put', wraps=store.put) as put:
+            schema, rows = load_schema(self.headers, iter(self.rows), worker.get_fields_parser(), store)
+            unknown = len(schema.unknown_columns())
+            list(rows)
+        self.assertTrue(schema.complete)
+        chunks = -(-(len(self.rows) - ReportSchema.SAMPLE_ROWS) // ReportSchema.LEARN_CHUNK_ROWS)
+        # the sampled schema, then at most once per chunk and once at the end of the pass
+        self.assertLessEqual(put.call_count, min(unknown, chunks + 1) + 1)
+
+    def test_learned_types_shipped_by_the_learning_run(self):
+        headers = ['name', 'amount']
+        # the values are in the chunk after the sample, the one the column is learned from
+        rows = [['a', '']] * ReportSchema.LEARN_CHUNK_ROWS + [['b', '1.5']] * ReportSchema.LEARNED_VALUES
+        sent = unittest.mock.Mock()
+        with unittest.mock.patch.dict(worker._schema_cache, clear=True):
+            worker._ship_rows(headers, iter(rows), sent, 'now', {}, MemoryStore())
+        logs = [json.loads(call[0][0]) for call in sent.add_json.call_args_list]
+        self.assertEqual([log['amount'] for log in logs if 'amount' in log], [1.5] * ReportSchema.LEARNED_VALUES)
+
+    def test_fallback_columns_cached_as_text(self):
+        headers = ['name', 'product_maxIopsvolume']
+        rows = [['a', '3000'], ['b', '3000 - based on 16 KiB I/O size']]
+        store = MemoryStore()
+        sent = unittest.mock.Mock()
+        with unittest.mock.patch.dict(worker._schema_cache, clear=True):
+            schema, _ = load_schema(headers, iter(rows[:1]), {}, store)
+            self.assertEqual(schema.types['product_maxIopsvolume'], 'float')
+            worker._ship_rows(headers, iter(rows), sent, 'now', {}, store)
+        logs = [json.loads(call[0][0]) for call in sent.add_json.call_args_list]
+        self.assertEqual([log['product_maxIopsvolume'] for log in logs], [3000.0, '3000 - based on 16 KiB I/O size'])
+
+        # the next runs ship the column as text
+        cached, _ = load_schema(headers, iter(rows), {}, store)
+        self.assertEqual(cached.types['product_maxIopsvolume'], 'str')
+
+    def test_cached_by_header_signature(self):
+        headers = ['amount', 'name']
+        rows = [['1', 'a'], ['2', 'b']]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            schema, _ = load_schema(headers, iter(rows), {}, FileStore(cache_dir))
+            self.assertTrue(schema.complete)
+
+            # a new process finds the schema in the store and doesn't sample the rows
+            rows_iter = iter(rows)
+            cached, cached_rows = load_schema(headers, rows_iter, {}, FileStore(cache_dir))
+            self.assertIs(cached_rows, rows_iter)
+            self.assertEqual(cached.types, schema.types)
+
+            load_schema(['name', 'amount'], iter([['a', '1']]), {}, FileStore(cache_dir))
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+    def test_complete_after_a_full_pass(self):
+        # the normalization columns have values late in report 1 only
+        for report, normalization_type in ((SAMPLE_CSV_GZIP_1, 'float'), (SAMPLE_CSV_GZIP_2, 'str')):
+            with gzip.open(report) as f:
+                r = csv.reader(f.read().decode('utf-8').splitlines())
+                headers = [header.replace('/', '_') for header in next(r)]
+                rows = list(r)
+            with tempfile.TemporaryDirectory() as cache_dir:
+                _, learning_rows = load_schema(headers, iter(rows), worker.get_fields_parser(), FileStore(cache_dir))
+                self.assertEqual(list(learning_rows), rows)
+
+                # columns empty in the whole report are resolved, the next run doesn't look at the rows
+                rows_iter = iter(rows)
+                schema, cached_rows = load_schema(headers, rows_iter, worker.get_fields_parser(),
+                                                  FileStore(cache_dir))
+                self.assertTrue(schema.complete)
+                self.assertIs(cached_rows, rows_iter)
+                self.assertEqual(schema.types['reservation_EffectiveCost'], 'float')
+                self.assertEqual(schema.types['lineItem_NormalizationFactor'], normalization_type)
+
+    def test_partial_pass_leaves_empty_columns_unknown(self):
+        headers = ['amount', 'fee']
+        cache = {}
+        _, rows = load_schema(headers, iter([['1', ''], ['2', '']]), {}, None, cache, whole_report=False)
+        list(rows)
+        self.assertFalse(list(cache.values())[0].complete)
+
+    def test_s3_store(self):
+        s3client = LocalS3Client()
+        store = S3Store(s3client, 'bucket', 'prefix/report/logzio-cache/')
+        self.assertIsNone(store.get('schema-1.json'))
+        store.put('schema-1.json', {'types': {}})
+        self.assertEqual(store.get('schema-1.json'), {'types': {}})
+        self.assertEqual(s3client.get_object(Bucket='bucket', Key='prefix/report/logzio-cache/schema-1.json')[
+            'ContentLength'], len(json.dumps({'types': {}})))
+
+
+class TestReportIndex(unittest.TestCase):
+    """ Unit testing the time-windowed shipping of indexed report parts """
+
+    KEY = 'reports/cur/20180201-20180301/assembly/cur-1.csv.gz'
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.work_dir.name, 'report.csv.gz')
+        cur_generator.write_report(self.path, 2000, benchmark.EVENT_TIME, seed=1)
+        with gzip.open(self.path) as f:
+            r = csv.reader(f.read().decode('utf-8').splitlines())
+            self.headers = [header.replace('/', '_') for header in next(r)]
+            self.rows = list(r)
+        self.s3client = LocalS3Client()
+        self.s3client.put_file('bucket', self.KEY, self.path)
+        self.store = MemoryStore()
+        self.budget = MemoryBudget(64 * 1024 * 1024)
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def _ship(self, window_start):
+        ship = replay.NullShipper()
+        with unittest.mock.patch.object(ReportIndex, 'BLOCK_SIZE_IN_BYTES', 32 * 1024), \
+                unittest.mock.patch.object(ReportIndex, 'STEP_ROWS', 64):
+            worker._ship_report(self.s3client, 'bucket', self.KEY, ship, '2018-02-15 12:00:00',
+                                worker.get_fields_parser(), self.budget, self.store, window_start)
+        ship.close()
+        return ship.summary()['logs_sent']
+
+    def _rows_since(self, window_start):
+        usage_start, period_start, line_item_type = map(self.headers.index, (
+            'lineItem_UsageStartDate', 'bill_BillingPeriodStartDate', 'lineItem_LineItemType'))
+        return len([row for row in self.rows if row[usage_start] >= window_start or
+                    row[usage_start] == row[period_start] or row[line_item_type] != 'Usage'])
+
+    def test_generator_skips_to_offset(self):
+        gen = worker.CSVLineGenerator(open(self.path, 'rb'), read_chunk_size=1024, decompressed_chunk_size=4096)
+        rows = csv.reader(gen.stream_line())
+        offsets = [gen.offset for _ in itertools.islice(rows, 1000)]
+
+        gen = worker.CSVLineGenerator(open(self.path, 'rb'), read_chunk_size=1024, decompressed_chunk_size=4096)
+        gen.skip_to(offsets[499])
+        self.assertEqual(list(csv.reader(gen.stream_line())), self.rows[500:])
+        with self.assertRaises(ValueError):
+            gen.skip_to(0)
+
+    def test_window_skips_indexed_blocks(self):
+        with unittest.mock.patch.dict(os.environ, {'SHIP_WINDOW_DAYS': '3'}):
+            window_start = worker._ship_window_start('2018-02-15T12:00:00Z')
+        self.assertEqual(window_start, '2018-02-12T00:00:00Z')
+        expected = self._rows_since(window_start)
+        self.assertTrue(0 < expected < len(self.rows))
+
+        # the first run reads the whole part and indexes it
+        self.assertEqual(self._ship(window_start), expected)
+        index = load_report_index(self.store, self.KEY, self.s3client.get_object('bucket', self.KEY)['ETag'])
+        self.assertGreater(len(index.blocks), 2)
+
+        # later runs read the first block, with the usage of the period start, then the blocks with usage in the window
+        ranges = index.ranges(window_start)
+        self.assertEqual(len(ranges), 2)
+        self.assertEqual(ranges[0], index.blocks[0][::3])
+        self.assertLess(sum(count for _, count in ranges), len(self.rows))
+        skip_to = worker.CSVLineGenerator.skip_to
+        with unittest.mock.patch.object(worker.CSVLineGenerator, 'skip_to', autospec=True,
+                                        side_effect=skip_to) as mocked_skip_to:
+            self.assertEqual(self._ship(window_start), expected)
+        self.assertEqual([call[0][1] for call in mocked_skip_to.call_args_list], [offset for offset, _ in ranges])
+
+        # the Tax line items closing the part are shipped whatever the window
+        self.assertTrue(index.blocks[-1][2])
+        self.assertEqual(self._ship('2018-03-02T00:00:00Z'), self._rows_since('2018-03-02T00:00:00Z'))
+
+        # a part without usage in the window is not read at all
+        self.store.put('index-cur-1.csv.gz.json', ReportIndex(index.key, index.etag, [
+            [offset, latest_start, False, rows] for offset, latest_start, _, rows in index.blocks]).to_json())
+        with unittest.mock.patch.object(worker, 'CSVLineGenerator') as mocked_generator:
+            self.assertEqual(self._ship('2018-03-02T00:00:00Z'), 0)
+        mocked_generator.assert_not_called()
+
+    def test_window_keeps_period_start_and_other_line_items(self):
+        headers = ['bill_BillingPeriodStartDate', 'lineItem_LineItemType', 'lineItem_UsageStartDate']
+        lines = [['2018-02-01T00:00:00Z', 'Usage', '2018-02-01T00:00:00Z'],
+                 ['2018-02-01T00:00:00Z', 'Usage', '2018-02-05T00:00:00Z'],
+                 ['2018-02-01T00:00:00Z', 'Tax', '2018-02-01T00:00:00Z'],
+                 ['2018-02-01T00:00:00Z', 'Credit', '2018-02-05T00:00:00Z'],
+                 ['2018-02-01T00:00:00Z', 'Usage', '2018-02-13T00:00:00Z']]
+        within_window = usage_window_filter('2018-02-12T00:00:00Z')
+        self.assertEqual(list(within_window(ColumnBatch(headers, lines))), [True, False, True, True, True])
+        # reports without the line item type only keep the rows of the period start
+        self.assertEqual(list(within_window(ColumnBatch(headers[::2], [line[::2] for line in lines]))),
+                         [True, False, True, False, True])
+
+    def test_index_without_kept_rows_is_built_again(self):
+        self._ship('2018-02-12T00:00:00Z')
+        etag = self.s3client.get_object('bucket', self.KEY)['ETag']
+        content = self.store.get('index-cur-1.csv.gz.json')
+        self.store.put('index-cur-1.csv.gz.json', dict(content, blocks=[block[:2] for block in content['blocks']]))
+        self.assertIsNone(load_report_index(self.store, self.KEY, etag))
+
+    def test_new_version_of_part_is_indexed_again(self):
+        self._ship('2018-02-12T00:00:00Z')
+        with open(self.path, 'rb') as f:
+            self.s3client.put_object('bucket', self.KEY, f.read())
+        etag = self.s3client.get_object('bucket', self.KEY)['ETag']
+        self.assertIsNone(load_report_index(self.store, self.KEY, etag))
+
+        self.assertEqual(self._ship('2018-02-20T00:00:00Z'), self._rows_since('2018-02-20T00:00:00Z'))
+        self.assertIsNotNone(load_report_index(self.store, self.KEY, etag))
+        # without a window, every row is shipped
+        self.assertEqual(self._ship(None), len(self.rows))
+
+    def test_new_report_version_replaces_index(self):
+        self._ship('2018-02-12T00:00:00Z')
+        # the next report version is delivered under a new assembly folder, with the same part file names
+        self.KEY = self.KEY.replace('/assembly/', '/assembly-2/')
+        self.s3client.put_file('bucket', self.KEY, self.path)
+        self._ship('2018-02-12T00:00:00Z')
+
+        self.assertEqual([name for name in self.store._documents if name.startswith('index-')],
+                         ['index-cur-1.csv.gz.json'])
+        self.assertEqual(self.store.get('index-cur-1.csv.gz.json')['key'], self.KEY)
+
+
 if __name__ == '__main__':
     unittest.main()